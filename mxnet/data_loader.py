@@ -1,26 +1,46 @@
 import mxnet as mx
 import numpy as np
 import os
-import time
-from multiprocessing import Process, Queue
+import copy
+import ctypes
+import threading
+import traceback
+from multiprocessing import Process, Queue, RawArray, RawValue
+try:
+    from Queue import Queue as ThreadQueue, Empty
+except ImportError:
+    from queue import Queue as ThreadQueue, Empty
 
-from commons import pickle_from_file
+from commons import pickle_from_file, spawn_rngs
 
 class BaseLoader(mx.io.DataIter):
     """
     Base data loader for MXNet training
     """
-    def __init__(self, root='', batch_size=16, split='train', shuffle=False, include_trailing=False, num_workers=4, prefetch_ratio=3.0, cached_dataset=''):
+    def __init__(self, root='', batch_size=16, split='train', shuffle=False, include_trailing=False, num_workers=4, prefetch_ratio=3.0, cached_dataset='', seed=None, ordered=None, backend='process',
+                 data_dtype=np.float32, label_dtype=np.float32, ctx=None):
         """
         shuffle: whether to shuffle the dataset in each epoch
-        include_trailing: when num_workers == 1, this determines whether to include the final few samples. Useful for validation.
-        num_workers: number of worker processes to read data. Multiple workers mode is only supported in training phase.
-        prefetch_ratio: this determines the size of the prefetch queue in terms of batch_size
+        include_trailing: this determines whether to include the final few samples. Useful for validation.
+        num_workers: number of worker processes to read data. Workers load the batches of each epoch from one globally shuffled index stream, call reset() between epochs.
+        prefetch_ratio: this determines the size of the prefetch queue in terms of batch_size, i.e. the number of batches assembled ahead
         cached_dataset: if specified, will use the cached dataset instead of reading from disk. The cached dataset is a list of (data, label). If cached_dataset is specified, this will override include_trailing, num_workers, prefetch_ratio.
+        seed: seed of self.rng, which shuffles the dataset and should be used by _get_item for augmentation (e.g. pclib functions take rng=self.rng).
+              With multiple workers, every batch gets its own stream seeded by (seed, epoch, batch index), so results do not depend on which worker loads which batch.
+              If None, the main process uses the global np.random state and the workers are seeded from OS entropy.
+        ordered: with multiple workers, deliver batches in index stream order rather than as soon as they are ready. Default: True unless shuffle
+        backend: how num_workers workers run
+                 'process': forked processes, for CPU-bound _get_item
+                 'thread': threads sharing self.dataset, for _get_item dominated by file reads and cv2 decodes, which release the GIL
+                 'asyncio': one event loop thread loading the samples of a batch concurrently through _get_item_async (python 3 only),
+                            by default _get_item on a pool of num_workers threads
+        data_dtype, label_dtype: dtypes of the batch arrays, samples are converted to them as they are copied into the batch
+        ctx: context of the batch arrays, e.g. mx.cpu_pinned() to speed up copies to the GPU. Default: mx.cpu()
+             The batch arrays are allocated once and refilled by every batch, copy them to keep a batch beyond the next call to next()
         
         To extend this base loader:
         1. implement _set_input_shapes(), _read_dataset(), _get_item()
-        2. call start_workers() in the constructor to enable multiple workers mode.
+        2. call start_workers() in the constructor to enable multiple workers mode. stop_workers() shuts them down, restart_workers() replaces them.
         """
         self.root = root
         self.batch_size = batch_size
@@ -29,43 +49,65 @@ class BaseLoader(mx.io.DataIter):
         # shuffle dataset before each epoch begins
         self.shuffle = shuffle
         if self.split == 'train' and self.shuffle == False:
-            print "Warning: Phase is set to train, but shuffle flag is False."
+            print("Warning: Phase is set to train, but shuffle flag is False.")
         elif self.split != 'train' and self.shuffle == True:
-            print "Warning: Phase is set to {}, but shuffle flag is True.".format(self.split)
+            print("Warning: Phase is set to {}, but shuffle flag is True.".format(self.split))
 
         # whether to include the trailing batch with less than batch_size samples
         # if True, the last batch will be padded by the last sample to make batch_size the same
         self.include_trailing = include_trailing
         if self.split == 'train' and self.include_trailing == True:
-            print "Warning: Phase is set to train, but include_trailing flag is True."
+            print("Warning: Phase is set to train, but include_trailing flag is True.")
         elif self.split != 'train' and self.include_trailing == False:
-            print "Warning: Phase is set to {}, but include_trailing flag is False.".format(self.split)
+            print("Warning: Phase is set to {}, but include_trailing flag is False.".format(self.split))
 
         self.num_workers = num_workers
         self.prefetch_ratio = prefetch_ratio
-        if self.split != 'train' and self.num_workers > 1:
-            print "Warning: multiple workers mode is not fully supported in validation/test mode."
+
+        # random streams: one for the main process and one for each worker
+        self.seed = seed
+        self._rngs = spawn_rngs(seed, self.num_workers + 1)
+        self.rng = np.random if seed is None else self._rngs[0]
+        self.ordered = not self.shuffle if ordered is None else ordered
+        assert backend in ('process', 'thread', 'asyncio'), 'unknown backend: {}'.format(backend)
+        if backend == 'asyncio':
+            try:
+                import asyncio
+            except ImportError:
+                raise ValueError('the asyncio backend requires python 3')
+        self.backend = backend
+        self.data_dtype = np.dtype(data_dtype)
+        self.label_dtype = np.dtype(label_dtype)
+        self.ctx = mx.cpu() if ctx is None else ctx
+        self.epoch = 0
+        self.workers = []
 
         # dataset. May use a cached dataset to avoid any randomness
         self.cached_dataset = cached_dataset
         if self.cached_dataset == '':
-            print 'Reading dataset from', self.root
+            print('Reading dataset from {}'.format(self.root))
             self._read_dataset()
         else:
-            print 'Reading cached dataset from', self.cached_dataset
+            print('Reading cached dataset from {}'.format(self.cached_dataset))
             self._read_cached_dataset()
         self.num_samples = len(self.dataset)
-        print 'Number of samples:', self.num_samples
+        print('Number of samples: {}'.format(self.num_samples))
 
         # calculate number of batches
         self.num_batches = self.num_samples // self.batch_size
         if self.include_trailing and self.num_batches * self.batch_size < self.num_samples:
-            self.num_batches += 1  # final batch
             self.trailing_count = self.num_samples - self.num_batches * self.batch_size
+            self.num_batches += 1  # final batch
 
         # specify input shapes
         self._set_input_shapes()
-        print 'data_shape:', self.data_shape, 'label_shape:', self.label_shape
+        print('data_shape: {} label_shape: {}'.format(self.data_shape, self.label_shape))
+
+        # batch buffers, reused by every batch
+        self.batch_data = np.empty(self.data_shape, dtype=self.data_dtype)
+        self.batch_label = np.empty(self.label_shape, dtype=self.label_dtype)
+        self.nd_data = mx.nd.zeros(self.data_shape, ctx=self.ctx, dtype=self.data_dtype)
+        self.nd_label = mx.nd.zeros(self.label_shape, ctx=self.ctx, dtype=self.label_dtype)
 
         self.reset()
 
@@ -75,42 +117,148 @@ class BaseLoader(mx.io.DataIter):
         """
         raise NotImplementedError
 
+    def _slot_array(self, shape, dtype):
+        """ array of batch slots. For the process backend a view of a new shared memory block, visible to worker processes forked afterwards """
+        dtype = np.dtype(dtype)
+        if self.backend != 'process':
+            return np.empty(shape, dtype=dtype)
+        raw = RawArray(ctypes.c_char, int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
     def start_workers(self):
-        """ split dataset into num_workers parts, spawn a process to read from each part """
-        if self.num_workers > 1:
-            self.data_queue = Queue()
-            ids = list(np.linspace(0, self.num_samples, self.num_workers, endpoint=False, dtype=int))
-            ids.append(self.num_samples)
-            for i in xrange(self.num_workers):
-                p = Process(target=self._data_worker, args=(np.arange(ids[i], ids[i+1]),))
+        """ spawn num_workers workers (see backend) loading the remaining batches of the current epoch
+        workers assemble whole batches into a ring of slots, shared memory for processes, only batch and slot indices go through the queues.
+        The ring has ceil(prefetch_ratio) slots (at least 2), which bounds the number of batches loaded ahead
+        """
+        if self.num_workers > 1 and not self.workers:
+            self.num_slots = max(2, int(np.ceil(self.prefetch_ratio)))
+            self.slot_data = self._slot_array((self.num_slots,) + tuple(self.data_shape), self.data_dtype)
+            self.slot_label = self._slot_array((self.num_slots,) + tuple(self.label_shape), self.label_dtype)
+            # bounded by the number of slots, so puts never block for long
+            queue_type = Queue if self.backend == 'process' else ThreadQueue
+            self.task_queue = queue_type(self.num_slots + self.num_workers)
+            self.full_slots = queue_type(self.num_slots)
+            # epoch of the main process, tasks of older epochs are returned unloaded
+            self.shared_epoch = RawValue(ctypes.c_long, self.epoch)
+            if self.backend == 'process':
+                workers = [Process(target=self._data_worker, args=(self._rngs[i+1],)) for i in range(self.num_workers)]
+            elif self.backend == 'thread':
+                # every thread works on a shallow copy, so it has its own self.rng but shares self.dataset
+                workers = [threading.Thread(target=copy.copy(self)._data_worker, args=(self._rngs[i+1],)) for i in range(self.num_workers)]
+            else:
+                workers = [threading.Thread(target=copy.copy(self)._async_worker, args=(self._rngs[1],))]
+            for p in workers:
                 p.daemon = True
                 p.start()
+                self.workers.append(p)
+            self.free_slots = list(range(self.num_slots))
+            self.next_task = self.batch_idx
+            self.ready = {}
+            self._schedule()
+
+    def stop_workers(self, timeout=5):
+        """ shut down the worker processes. Afterwards batches are loaded in the main process until start_workers() is called """
+        if not self.workers: return
+        for _ in self.workers:
+            self.task_queue.put(None)
+        # batches still being loaded are dropped, drain them so no worker blocks on a full queue
+        for p in self.workers:
+            while p.is_alive():
+                try:
+                    self.full_slots.get(timeout=0.1)
+                except Empty:
+                    pass
+                p.join(0)
+                timeout -= 0.1
+                # threads cannot be terminated, they exit after their current batch
+                if timeout <= 0 and self.backend == 'process': p.terminate()
+            p.join()
+        self.workers = []
+
+    def restart_workers(self):
+        """ replace the worker processes, e.g. after a worker died. The current epoch continues with the next batch not yet returned
+        (unordered, batches returned out of order may be repeated or skipped)
+        """
+        self.stop_workers()
+        self.start_workers()
+
+    def _batch_ids(self, batch_idx):
+        """ dataset indices of a batch. The trailing batch is padded by the last sample """
+        start_idx = batch_idx * self.batch_size
+        return self.ids[np.minimum(np.arange(start_idx, start_idx + self.batch_size), self.ids.size - 1)]
 
-    def _data_worker(self, worker_ids):
-        """ code for each worker process
-        workers_ids: indices for self.dataset. Subset of all indices for this worker process
+    def _schedule(self):
+        """ hand out the next batches of the epoch, one per free slot """
+        while self.free_slots and self.next_task < self.num_batches:
+            self.task_queue.put((self.epoch, self.next_task, self._batch_ids(self.next_task), self.free_slots.pop()))
+            self.next_task += 1
+
+    def _data_worker(self, rng):
+        """ code for each worker
+        takes (epoch, batch index, dataset indices, slot) tasks, fills the slot, returns (epoch, batch index, slot)
+        rng: random stream of this worker process, used if seed is None
+        a None task shuts the worker down. Exceptions of _get_item are sent back as formatted tracebacks and raised by the main process
         """
-        ids = np.arange(len(worker_ids))
-        if self.shuffle: np.random.shuffle(ids)
-        ids_ptr = 0
+        self.rng = rng
+        # forked workers inherit the random state of the main process, reseed the global state for code still using it
+        if self.backend == 'process':
+            np.random.seed(int(rng.uniform() * 0x7fffffff))
         while True:
-            if self.data_queue.qsize() > self.batch_size * self.prefetch_ratio: # enough data in data_queue
-                time.sleep(1)
-            else:
-                if ids_ptr == len(worker_ids):
-                    ids_ptr = 0
-                    if self.shuffle: np.random.shuffle(ids)
-                idx = worker_ids[ids[ids_ptr]]
-                data, label = self._get_item(idx)
-                self.data_queue.put((data, label))
-                ids_ptr += 1
+            try:
+                task = self.task_queue.get()
+            except KeyboardInterrupt:
+                return
+            if task is None:
+                return
+            epoch, batch_idx, ids, slot = task
+            error = None
+            if epoch == self.shared_epoch.value:
+                try:
+                    if self.seed is not None:
+                        self.rng = np.random.RandomState([self.seed, epoch, batch_idx])
+                    batch_data, batch_label = self.slot_data[slot], self.slot_label[slot]
+                    for i, (data, label) in enumerate(self._load_samples(ids)):
+                        batch_data[i], batch_label[i] = data, label
+                except Exception:
+                    error = traceback.format_exc()
+            self.full_slots.put((epoch, batch_idx, slot, error))
+
+    def _load_samples(self, ids):
+        """ (data, label) of every index in ids. Replaced by _async_worker to load them concurrently """
+        return (self._get_item(idx) for idx in ids)
+
+    def _async_worker(self, rng):
+        """ code of the asyncio backend: _data_worker, with the samples of every batch loaded concurrently on an event loop """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._executor = ThreadPoolExecutor(self.num_workers)
+        self._load_samples = lambda ids: self._loop.run_until_complete(asyncio.gather(*[self._get_item_async(idx) for idx in ids]))
+        try:
+            self._data_worker(rng)
+        finally:
+            self._executor.shutdown()
+            self._loop.close()
+
+    def _get_item_async(self, index):
+        """ awaitable of _get_item(index) for the asyncio backend. Override with a coroutine to use asynchronous I/O """
+        return self._loop.run_in_executor(self._executor, self._get_item, index)
 
     def reset(self):
+        """ start a new epoch. With multiple workers, batches of the previous epoch still being loaded are discarded """
         self.batch_idx = 0
-        if self.num_workers == 1:
-            self.ids = np.arange(self.num_samples)
-            if self.shuffle:
-                np.random.shuffle(self.ids)
+        self.epoch += 1
+        self.ids = np.arange(self.num_samples)
+        if self.shuffle:
+            self.rng.shuffle(self.ids)
+        if self.workers:
+            self.shared_epoch.value = self.epoch
+            self.next_task = 0
+            # batches loaded but not returned are dropped, their slots go back to the ring
+            self.free_slots.extend(slot for slot, _ in self.ready.values())
+            self.ready = {}
+            self._schedule()
 
     def _read_dataset(self):
         raise NotImplementedError
@@ -152,21 +300,57 @@ class BaseLoader(mx.io.DataIter):
             data, label = self.dataset[i]
         return data, label
 
+    def _wait_batch(self, batch_idx):
+        """ slot of a loaded batch of this epoch: batch batch_idx if ordered, otherwise whichever is ready first
+        raises RuntimeError if the worker loading it failed, or if a worker died
+        """
+        while True:
+            if self.ordered and batch_idx in self.ready:
+                idx, (slot, error) = batch_idx, self.ready.pop(batch_idx)
+                break
+            if not self.ordered and self.ready:
+                idx, (slot, error) = self.ready.popitem()
+                break
+            try:
+                epoch, idx, slot, error = self.full_slots.get(timeout=1)
+            except Empty:
+                dead = [p.name for p in self.workers if not p.is_alive()]
+                if dead:
+                    # this batch is loaded again after restart_workers()
+                    self.batch_idx = batch_idx
+                    raise RuntimeError('data loading workers {} died unexpectedly, call restart_workers() to continue'.format(dead))
+                continue
+            if epoch == self.epoch:
+                self.ready[idx] = (slot, error)
+            else:
+                self.free_slots.append(slot)
+                self._schedule()
+        if error is not None:
+            self.free_slots.append(slot)
+            self._schedule()
+            raise RuntimeError('data loading worker failed on batch {}:\n{}'.format(idx, error))
+        return slot
+
     def _next_batch(self):
+        batch_idx = self.batch_idx
         start_idx = self.batch_idx * self.batch_size
         self.batch_idx += 1
-        batch_data = np.zeros(self.data_shape)
-        batch_label = np.zeros(self.label_shape, dtype=np.int32)
-        for i in xrange(self.batch_size):
-            if self.num_workers == 1:
-                data, label = self.__getitem__(self.ids[min(i+start_idx, self.ids.size-1)])
-            else:
-                data, label = self.data_queue.get()
-            batch_data[i] = data
-            batch_label[i] = label
-        batch_data = [mx.nd.array(batch_data)]
-        batch_label = [mx.nd.array(batch_label)]
-        return mx.io.DataBatch(data=batch_data, label=batch_label)
+        if self.workers:
+            # the slot is handed back to the workers as soon as it is copied into the batch arrays
+            slot = self._wait_batch(batch_idx)
+            batch_data, batch_label = self.slot_data[slot], self.slot_label[slot]
+        else:
+            slot = None
+            batch_data, batch_label = self.batch_data, self.batch_label
+            # every row is overwritten, the trailing batch is padded by the last sample
+            for i in range(self.batch_size):
+                batch_data[i], batch_label[i] = self.__getitem__(self.ids[min(i+start_idx, self.ids.size-1)])
+        self.nd_data[:] = batch_data
+        self.nd_label[:] = batch_label
+        if slot is not None:
+            self.free_slots.append(slot)
+            self._schedule()
+        return mx.io.DataBatch(data=[self.nd_data], label=[self.nd_label])
 
 
 ###################################
@@ -184,7 +368,7 @@ def cache_dataset(dataloader, output):
         if end > dataloader.num_samples:
             batch_data = batch_data[:dataloader.trailing_count]
             batch_label = batch_label[:dataloader.trailing_count]
-        for j in xrange(batch_label.shape[0]):
+        for j in range(batch_label.shape[0]):
             data.append((batch_data[j], batch_label[j]))
     pickle_to_file(data, output)
 
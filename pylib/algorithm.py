@@ -2,72 +2,508 @@
 simple algorithms
 '''
 
-def kmeans(data, k, distance=None, initial_centeroids=None, iteration_threshold=1e-4, max_iteration=1000, stop_at_local_minimum=False, verbose=False):
+def _sq_euclidean(data, centeroids, data_sq=None, centeroids_sq=None):
+    '''squared Euclidean distances between every row of data (n*D) and every row of centeroids (k*D)
+    data_sq, centeroids_sq: optional precomputed squared norms of the rows
+    returns: n*k ndarray
+    '''
+    import numpy as np
+    if data_sq is None: data_sq = np.einsum('ij,ij->i', data, data)
+    if centeroids_sq is None: centeroids_sq = np.einsum('ij,ij->i', centeroids, centeroids)
+    dist = np.dot(data, centeroids.T)
+    dist *= -2
+    dist += data_sq[:, None]
+    dist += centeroids_sq[None, :]
+    np.maximum(dist, 0, out=dist)  # guard against round-off
+    return dist
+
+def _pairwise_from_distance(distance):
+    '''wrap a per-pair distance function dist = distance(x1, x2) into a pairwise one'''
+    import numpy as np
+    def pairwise(data, centeroids):
+        dist = np.empty((data.shape[0], centeroids.shape[0]))
+        for j in range(centeroids.shape[0]):
+            c = centeroids[j]
+            dist[:, j] = [distance(x, c) for x in data]
+        return dist
+    return pairwise
+
+def _default_chunk_size(k, max_entries=1<<22):
+    '''number of rows per distance block, so that a block holds at most max_entries distances (32MB in float64)'''
+    return max(1, max_entries // max(k, 1))
+
+def _assign(data, centeroids, pairwise_distance=None, chunk_size=None, data_sq=None):
+    '''assign every row of data to its nearest centeroid, chunk by chunk to bound memory
+    returns: group_ids (int vector of size N), min_dists (float vector of size N)
+    '''
+    import numpy as np
+    data_size = data.shape[0]
+    if chunk_size is None: chunk_size = _default_chunk_size(centeroids.shape[0])
+    group_ids = np.empty(data_size, dtype=np.intp)
+    min_dists = np.empty(data_size)
+    if pairwise_distance is None:
+        centeroids_sq = np.einsum('ij,ij->i', centeroids, centeroids)
+    rows = np.arange(min(chunk_size, data_size))
+    for start in range(0, data_size, chunk_size):
+        end = min(start + chunk_size, data_size)
+        if pairwise_distance is None:
+            dist = _sq_euclidean(data[start:end], centeroids,
+                                 None if data_sq is None else data_sq[start:end], centeroids_sq)
+        else:
+            dist = np.asarray(pairwise_distance(data[start:end], centeroids), dtype=float)
+        ids = np.argmin(dist, axis=1)
+        group_ids[start:end] = ids
+        min_dists[start:end] = dist[rows[:end-start], ids]
+    return group_ids, min_dists
+
+def _update_centeroids(data, group_ids, k):
+    '''mean of the rows of data in each group
+    returns: centeroids (k*D), counts (vector of size k). Rows of empty groups are left as nan
+    '''
+    import numpy as np
+    counts = np.bincount(group_ids, minlength=k)
+    centeroids = np.empty((k, data.shape[1]))
+    for d in range(data.shape[1]):
+        centeroids[:, d] = np.bincount(group_ids, weights=data[:, d], minlength=k)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centeroids /= counts[:, None]
+    return centeroids, counts
+
+def _get_rng(random_state):
+    '''np.random module for None, a RandomState seeded with random_state for int, otherwise random_state itself'''
+    import numpy as np
+    if random_state is None: return np.random
+    if isinstance(random_state, (int, np.integer)): return np.random.RandomState(random_state)
+    return random_state
+
+def _kmeanspp_init(data, k, rng, pairwise_distance=None, chunk_size=None, data_sq=None, weights=None):
+    '''k-means++ seeding: every new centeroid is sampled with probability proportional to its distance to the nearest chosen one
+    weights: optional per-point weights, used when seeding from the k-means|| candidates
+    returns: k*D ndarray
+    '''
+    import numpy as np
+    data_size = data.shape[0]
+    p = None if weights is None else weights / np.sum(weights)
+    centeroids = np.empty((k, data.shape[1]))
+    centeroids[0] = data[rng.choice(data_size, p=p)]
+    min_dists = _assign(data, centeroids[:1], pairwise_distance, chunk_size, data_sq)[1]
+    for i in range(1, k):
+        prob = min_dists if weights is None else min_dists * weights
+        total = np.sum(prob)
+        idx = rng.choice(data_size, p=prob / total) if total > 0 else rng.randint(0, data_size)
+        centeroids[i] = data[idx]
+        np.minimum(min_dists, _assign(data, centeroids[i:i+1], pairwise_distance, chunk_size, data_sq)[1], out=min_dists)
+    return centeroids
+
+def _kmeans_parallel_init(data, k, rng, pairwise_distance=None, chunk_size=None, data_sq=None, oversampling_factor=2., rounds=5):
+    '''scalable k-means++ (k-means||) seeding
+    each round samples about oversampling_factor*k candidates independently, proportionally to their distance to the current candidates.
+    The candidates are then weighted by the size of their voronoi cells and reduced to k centeroids by k-means++
+    returns: k*D ndarray
+    '''
+    import numpy as np
+    data_size = data.shape[0]
+    candidates = data[rng.randint(0, data_size, 1)].astype(np.float64)
+    min_dists = _assign(data, candidates, pairwise_distance, chunk_size, data_sq)[1]
+    for _ in range(rounds):
+        total = np.sum(min_dists)
+        if total <= 0: break
+        prob = oversampling_factor * k * min_dists / total
+        new_candidates = data[rng.uniform(size=data_size) < prob].astype(np.float64)
+        if new_candidates.shape[0] == 0: continue
+        candidates = np.vstack((candidates, new_candidates))
+        np.minimum(min_dists, _assign(data, new_candidates, pairwise_distance, chunk_size, data_sq)[1], out=min_dists)
+    if candidates.shape[0] <= k:
+        # too few distinct candidates, top up with random points
+        extra = data[rng.randint(0, data_size, k - candidates.shape[0])]
+        return np.vstack((candidates, extra))
+    group_ids = _assign(data, candidates, pairwise_distance, chunk_size, data_sq)[0]
+    weights = np.bincount(group_ids, minlength=candidates.shape[0]).astype(np.float64)
+    return _kmeanspp_init(candidates, k, rng, pairwise_distance, weights=weights)
+
+def _init_centeroids(data, k, init, rng, pairwise_distance=None, chunk_size=None, data_sq=None):
+    '''initial centeroids according to init, see kmeans'''
+    import numpy as np
+    if init == 'random':
+        return data[rng.randint(0, data.shape[0], k), :].astype(np.float64)
+    elif init == 'k-means++':
+        return _kmeanspp_init(data, k, rng, pairwise_distance, chunk_size, data_sq)
+    elif init == 'k-means||':
+        return _kmeans_parallel_init(data, k, rng, pairwise_distance, chunk_size, data_sq)
+    else:
+        raise ValueError('unknown init method: {}'.format(init))
+
+def _reinit_empty(centeroids, counts, data, rng, verbose):
+    '''move the centeroids without any data point to random points of data'''
+    import numpy as np
+    for i in np.where(counts == 0)[0]:
+        if verbose: print('No data points around centeroid {} Re-initializing...'.format(i))
+        centeroids[i, :] = data[rng.randint(0, data.shape[0]), :]
+
+def _kmeans_lloyd(data, k, centeroids, rng, iteration_threshold, max_iteration, stop_at_local_minimum, verbose,
+                  pairwise_distance, chunk_size, data_sq, stats=None):
+    '''one run of Lloyd iterations starting from centeroids
+    stats: optional dict, 'iterations' and 'distance_evaluations' are written to it
+    returns: centeroids, group_ids, inertia (sum of distances of the final assignment)
+    '''
+    import numpy as np
+    prev_diff = 0x7fffffff
+    diff = prev_diff / 2
+    iter_ = 0
+    while abs(diff - prev_diff) > iteration_threshold and iter_ < max_iteration:
+        iter_ += 1
+        prev_diff = diff
+        group_ids, min_dists = _assign(data, centeroids, pairwise_distance, chunk_size, data_sq)
+        diff = np.sum(min_dists)
+        if verbose: print('iteration {} loss = {}'.format(iter_, diff))
+        if stop_at_local_minimum and diff > prev_diff: break
+        new_centeroids, counts = _update_centeroids(data, group_ids, k)
+        _reinit_empty(new_centeroids, counts, data, rng, verbose)
+        centeroids = new_centeroids
+    if stats is not None:
+        stats['iterations'] = iter_
+        stats['distance_evaluations'] = iter_ * data.shape[0] * k
+    return centeroids, group_ids, diff
+
+def _pair_dists(data, rows, centeroids, cols, max_entries=1<<22):
+    '''Euclidean distances between data[rows[i]] and centeroids[cols[i]] for every i
+    pairs are evaluated in blocks of at most max_entries coordinates to bound memory
+    '''
+    import numpy as np
+    dists = np.empty(len(rows))
+    block = max(1, max_entries // data.shape[1])
+    for start in range(0, len(rows), block):
+        diff = data[rows[start:start+block]] - centeroids[cols[start:start+block]]
+        dists[start:start+block] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    return dists
+
+def _center_separation(centeroids):
+    '''returns: k*k Euclidean distances between centeroids with inf on the diagonal,
+    and half the distance from every centeroid to its nearest other centeroid'''
+    import numpy as np
+    center_dist = np.sqrt(_sq_euclidean(centeroids, centeroids))
+    np.fill_diagonal(center_dist, np.inf)
+    return center_dist, 0.5 * np.min(center_dist, axis=1)
+
+def _inertia(data, centeroids, group_ids):
+    '''sum of squared Euclidean distances of every point to its assigned centeroid'''
+    import numpy as np
+    return np.sum(_pair_dists(data, np.arange(data.shape[0]), centeroids, group_ids) ** 2)
+
+def _kmeans_hamerly(data, k, centeroids, rng, iteration_threshold, max_iteration, stop_at_local_minimum, verbose,
+                    pairwise_distance, chunk_size, data_sq, stats=None):
+    '''one run of k-means accelerated by Hamerly's bounds (Hamerly, Making k-means even faster)
+    every point keeps an upper bound on the distance to its centeroid and a lower bound on the distance to the second closest one.
+    Points whose upper bound is below both the lower bound and half the distance to the nearest other centeroid cannot change group
+    iterates until no assignment changes, iteration_threshold and stop_at_local_minimum are not used
+    returns: centeroids, group_ids, inertia, see _kmeans_lloyd
+    '''
+    import numpy as np
+    data_size = data.shape[0]
+    if chunk_size is None: chunk_size = _default_chunk_size(k)
+    group_ids = np.empty(data_size, dtype=np.intp)
+    upper = np.empty(data_size)
+    lower = np.empty(data_size)
+
+    def full_assign(ids):
+        centeroids_sq = np.einsum('ij,ij->i', centeroids, centeroids)
+        for start in range(0, ids.size, chunk_size):
+            chunk = ids[start:start+chunk_size]
+            dist = _sq_euclidean(data[chunk], centeroids, data_sq[chunk], centeroids_sq)
+            nearest = np.argmin(dist, axis=1)
+            group_ids[chunk] = nearest
+            upper[chunk] = np.sqrt(dist[np.arange(chunk.size), nearest])
+            lower[chunk] = np.sqrt(np.partition(dist, 1, axis=1)[:, 1]) if k > 1 else np.inf
+
+    full_assign(np.arange(data_size))
+    evaluations = data_size * k
+    iter_ = 0
+    while iter_ < max_iteration:
+        iter_ += 1
+        new_centeroids, counts = _update_centeroids(data, group_ids, k)
+        _reinit_empty(new_centeroids, counts, data, rng, verbose)
+        shift = _pair_dists(new_centeroids, np.arange(k), centeroids, np.arange(k))
+        centeroids = new_centeroids
+        upper += shift[group_ids]
+        if k > 1:
+            # the second closest centeroid moved by at most the largest shift among the other centeroids
+            first, second = np.argsort(shift)[::-1][:2]
+            lower -= np.where(group_ids == first, shift[second], shift[first])
+        half_sep = _center_separation(centeroids)[1]
+        bound = np.maximum(half_sep[group_ids], lower)
+        ids = np.where(upper > bound)[0]
+        upper[ids] = _pair_dists(data, ids, centeroids, group_ids[ids])
+        evaluations += ids.size
+        ids = ids[upper[ids] > bound[ids]]
+        prev_ids = group_ids[ids]
+        full_assign(ids)
+        evaluations += ids.size * k
+        changed = np.count_nonzero(group_ids[ids] != prev_ids)
+        if verbose: print('iteration {} changed = {} full assignments = {}'.format(iter_, changed, ids.size))
+        if changed == 0: break
+    if stats is not None:
+        stats['iterations'] = iter_
+        stats['distance_evaluations'] = evaluations
+    return centeroids, group_ids, _inertia(data, centeroids, group_ids)
+
+_KMEANS_ALGORITHMS = {'lloyd': _kmeans_lloyd, 'hamerly': _kmeans_hamerly}
+
+# shared by the worker processes of kmeans(n_jobs > 1), set by _kmeans_pool_init
+_kmeans_pool_args = None
+
+def _kmeans_pool_init(*args):
+    global _kmeans_pool_args
+    _kmeans_pool_args = args
+
+def _kmeans_restart(seed, args=None):
+    '''one k-means restart seeded with seed. args defaults to the ones shared with the worker processes'''
+    import numpy as np
+    data, k, init, algorithm, kwargs = _kmeans_pool_args if args is None else args
+    rng = np.random.RandomState(seed)
+    centeroids = _init_centeroids(data, k, init, rng, kwargs['pairwise_distance'], kwargs['chunk_size'], kwargs['data_sq'])
+    return _KMEANS_ALGORITHMS[algorithm](data, k, centeroids, rng, **kwargs)
+
+def kmeans(data, k, distance=None, initial_centeroids=None, iteration_threshold=1e-4, max_iteration=1000, stop_at_local_minimum=False, verbose=False,
+           pairwise_distance=None, chunk_size=None, init='random', n_init=1, n_jobs=1, random_state=None, algorithm='lloyd'):
     '''k-means algorithm
     data: N*D ndarray, i.e. N D-dimensional vectors
-    distance function defaults to Euclidean. For user-specified distance function, the format is dist = distance(x1, x2), see Euclidean function
-    initial_centeroids are randomly selected from data, if not given
+    distance function defaults to squared Euclidean. For user-specified distance function, the format is dist = distance(x1, x2), where x1 and x2 are 1d ndarray.
+        A per-pair distance is evaluated in python for every (point, centeroid) pair, so prefer pairwise_distance for large data
+    initial_centeroids are selected from data according to init, if not given
     iteration_threshold: converge if difference of two iterations is below this value
     max_iteration: stop iteration if number of iterations exceeds this value
     verbose: if this flag is set, print out iteration details
+    pairwise_distance: vectorized distance function, dists = pairwise_distance(X, C), X is n*D, C is k*D, dists is n*k. Overrides distance
+    chunk_size: number of points per distance block, bounds memory to chunk_size*k distances. Defaults to 4M distances per block
+    init: seeding method when initial_centeroids is not given
+        'random': k random points of data
+        'k-means++': D^2 sampling, one centeroid at a time
+        'k-means||': scalable k-means++, oversamples candidates in a few rounds and reduces them by weighted k-means++
+    n_init: number of restarts with different seeds, the solution with the lowest loss is returned. Ignored if initial_centeroids is given
+    n_jobs: number of worker processes for the restarts. Custom distance functions must be picklable if n_jobs > 1
+    random_state: None (use the global np.random state), an int seed, or a np.random.RandomState
+    algorithm: 'lloyd' evaluates all N*k distances in every iteration.
+        'hamerly' keeps an upper and a lower bound per point and skips distances that provably cannot change the assignment,
+        using the triangle inequality, and iterates until no assignment changes.
+        It only supports the Euclidean distance, i.e. distance and pairwise_distance must be None
     returns: centeroids, group_ids
     centeroids: k*D ndarray
-    group_ids: vector of size N, i-th entry is an index [0, k), specifying which the group index it belongs to
+    group_ids: int vector of size N, i-th entry is an index [0, k), specifying which the group index it belongs to
     '''
     import numpy as np
 
-    def Euclidean(x1, x2):
-        '''exemplar (Euclidean) distance function
-        x1 and x2 are both 1d ndarray, return Euclidean distance'''
-        diff = x1 - x2
-        return np.sum(np.multiply(diff, diff))
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating): data = data.astype(np.float64)
+    rng = _get_rng(random_state)
+    if algorithm not in _KMEANS_ALGORITHMS:
+        raise ValueError('unknown k-means algorithm: {}'.format(algorithm))
+    if algorithm != 'lloyd' and (distance is not None or pairwise_distance is not None):
+        raise ValueError('k-means algorithm {} only supports the Euclidean distance'.format(algorithm))
+    if pairwise_distance is None and distance is not None:
+        pairwise_distance = _pairwise_from_distance(distance)
+    # squared norms of data are reused across iterations
+    data_sq = np.einsum('ij,ij->i', data, data) if pairwise_distance is None else None
+    kwargs = dict(iteration_threshold=iteration_threshold, max_iteration=max_iteration, stop_at_local_minimum=stop_at_local_minimum,
+                  verbose=verbose, pairwise_distance=pairwise_distance, chunk_size=chunk_size, data_sq=data_sq)
+
+    if initial_centeroids is not None:
+        centeroids = np.array(initial_centeroids, dtype=np.float64)
+        return _KMEANS_ALGORITHMS[algorithm](data, k, centeroids, rng, **kwargs)[:2]
+
+    if n_init == 1:
+        centeroids = _init_centeroids(data, k, init, rng, pairwise_distance, chunk_size, data_sq)
+        return _KMEANS_ALGORITHMS[algorithm](data, k, centeroids, rng, **kwargs)[:2]
+
+    seeds = rng.randint(0, 0x7fffffff, n_init)
+    if n_jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(n_jobs, n_init), initializer=_kmeans_pool_init, initargs=(data, k, init, algorithm, kwargs))
+        try:
+            results = pool.map(_kmeans_restart, seeds)
+        finally:
+            pool.terminate()
+    else:
+        results = [_kmeans_restart(seed, (data, k, init, algorithm, kwargs)) for seed in seeds]
+    best = min(range(n_init), key=lambda i: results[i][2])
+    if verbose: print('losses of {} restarts: {}, best = {}'.format(n_init, [r[2] for r in results], best))
+    return results[best][:2]
+
+
+class MiniBatchKMeans(object):
+    '''mini-batch k-means for data streamed in chunks, memory usage does not depend on the total number of points
+    Every centeroid is the running mean of all points assigned to it so far (Sculley, Web-scale k-means clustering)
+
+    Usage:
+        km = MiniBatchKMeans(k)
+        for chunk in chunks: km.partial_fit(chunk)
+    or
+        km.fit(np.load('points.npy', mmap_mode='r'), n_passes=2)
+    then km.centeroids, km.predict(data)
+    '''
+    def __init__(self, k, batch_size=4096, init='k-means++', init_size=None, random_state=None, chunk_size=None,
+                 reassignment_ratio=0.01):
+        '''
+        k: number of centeroids
+        batch_size: number of points per mini-batch when fit() slices large chunks
+        init: seeding method, see kmeans
+        init_size: number of points to seed the centeroids, defaults to 3*k.
+            fit() draws them at random rows of an ndarray, partial_fit() buffers them from the first chunks
+        random_state: None (use the global np.random state), an int seed, or a np.random.RandomState
+        chunk_size: number of points per distance block, see kmeans
+        reassignment_ratio: centeroids that have been assigned fewer than reassignment_ratio times the points of the
+            largest one are moved to points of the current mini-batch, sampled by their distance to the nearest centeroid
+        '''
+        self.k = k
+        self.batch_size = batch_size
+        self.init = init
+        self.init_size = 3 * k if init_size is None else max(init_size, k)
+        self.rng = _get_rng(random_state)
+        self.chunk_size = chunk_size
+        self.reassignment_ratio = reassignment_ratio
+        self.reset()
+
+    def reset(self):
+        self.centeroids = None
+        self.counts = None
+        self.num_points = 0
+        self.inertia = 0.  # sum of distances of the points at the time they were assigned
+        self._init_buffer = []
+
+    def _initialize(self):
+        '''seed the centeroids with the buffered points, returns the buffered points'''
+        import numpy as np
+        chunk = np.vstack(self._init_buffer)
+        self._init_buffer = []
+        self.centeroids = _init_centeroids(chunk, self.k, self.init, self.rng, chunk_size=self.chunk_size)
+        self.counts = np.zeros(self.k, dtype=np.int64)
+        return chunk
+
+    def partial_fit(self, chunk):
+        '''update the centeroids with one mini-batch, chunk: n*D ndarray
+        returns: self
+        '''
+        import numpy as np
+        chunk = np.asarray(chunk)
+        if not np.issubdtype(chunk.dtype, np.floating): chunk = chunk.astype(np.float64)
+        if self.centeroids is None:
+            self._init_buffer.append(chunk)
+            if sum(x.shape[0] for x in self._init_buffer) < self.init_size: return self
+            chunk = self._initialize()
+        group_ids, min_dists = _assign(chunk, self.centeroids, chunk_size=self.chunk_size)
+        sums, batch_counts = _update_centeroids(chunk, group_ids, self.k)
+        sums[batch_counts == 0] = 0
+        sums *= batch_counts[:, None]
+        # running mean: c += (sum - n_batch * c) / n_total
+        self.counts += batch_counts
+        updated = batch_counts > 0
+        self.centeroids[updated] += (sums[updated] - batch_counts[updated, None] * self.centeroids[updated]) / self.counts[updated, None]
+        # centeroids that starve (e.g. seeded in a sparse region) are moved to points of this batch far from all centeroids,
+        # and start with the count of the smallest surviving centeroid so that they are not reassigned again right away
+        low = self.counts < max(self.reassignment_ratio * self.counts.max(), 1)
+        if np.any(low) and not np.all(low):
+            p = min_dists.astype(np.float64)
+            total = np.sum(p)
+            p = p / total if total > 0 else None
+            self.centeroids[low] = chunk[self.rng.choice(chunk.shape[0], np.count_nonzero(low), p=p)]
+            self.counts[low] = np.min(self.counts[~low])
+        self.num_points += chunk.shape[0]
+        self.inertia += np.sum(min_dists)
+        return self
 
-    def update_group_index(data, centeroids):
+    def fit(self, chunks, n_passes=1):
+        '''consume all chunks n_passes times
+        chunks: an N*D ndarray (e.g. np.load(file_, mmap_mode='r')), an iterable of n*D ndarrays,
+                or a callable returning such an iterable, which is required if n_passes > 1 and chunks is a generator
+            For an ndarray, the seeds and every mini-batch are drawn at random rows, so data stored in any order
+            (e.g. cluster by cluster) is sampled evenly. Rows of a batch are read in ascending order, which suits memmaps.
+            Other chunks are shuffled and sliced into mini-batches of batch_size points, so the order of the chunks
+            themselves should not be correlated with the clusters
+        returns: self
+        '''
+        import numpy as np
+        if isinstance(chunks, np.ndarray):
+            size = chunks.shape[0]
+            if size == 0: return self
+            if self.centeroids is None and not self._init_buffer:
+                self._init_buffer = [chunks[np.sort(self.rng.choice(size, min(self.init_size, size), replace=False))]]
+                self._initialize()
+            for _ in range(n_passes * -(-size // self.batch_size)):
+                self.partial_fit(chunks[np.sort(self.rng.randint(0, size, min(self.batch_size, size)))])
+            return self
+        for _ in range(n_passes):
+            iterable = chunks() if callable(chunks) else chunks
+            for chunk in iterable:
+                chunk = np.asarray(chunk)[self.rng.permutation(chunk.shape[0])]
+                for start in range(0, chunk.shape[0], self.batch_size):
+                    self.partial_fit(chunk[start:start+self.batch_size])
+        if self.centeroids is None and self._init_buffer:
+            # fewer than init_size points in total
+            self.partial_fit(self._initialize())
+        return self
+
+    def predict(self, data):
+        '''returns: group_ids, index of the nearest centeroid for every row of data'''
+        return _assign(data, self.centeroids, chunk_size=self.chunk_size)[0]
+
+
+def _kmeans_loop(data, k, initial_centeroids, max_iteration):
+    '''reference implementation with per-point python loops, only used by _kmeans_benchmark'''
+    import numpy as np
+    data_size = data.shape[0]
+    centeroids = np.array(initial_centeroids, dtype=np.float64)
+    for _ in range(max_iteration):
         group_ids = np.zeros(data_size)
-        total_diff = 0
-        for i in xrange(data_size):
+        for i in range(data_size):
             min_diff = 0x7fffffff
-            idx = -1
-            for j in xrange(k):
-                diff = distance(data[i, :], centeroids[j, :])
+            for j in range(k):
+                diff = data[i, :] - centeroids[j, :]
+                diff = np.sum(np.multiply(diff, diff))
                 if diff < min_diff:
                     min_diff = diff
-                    idx = j
-            group_ids[i] = idx
-            total_diff += min_diff
-        return group_ids, total_diff
-    
-    def update_centeroids(data, centeroids, group_ids):
-        for i in xrange(k):
+                    group_ids[i] = j
+        for i in range(k):
             ids = np.where(group_ids == i)[0]
-            if ids.size > 0:
-                data_ = data[ids, :]
-                centeroids[i, :] = np.sum(data_, 0) / ids.size
-            else:
-                if verbose: print 'No data points around centeroid', i, 'Re-initializing...'
-                centeroids[i, :] = data[np.random.randint(0, data_size, 1), :]
-
-    data_size = data.shape[0]
-    if distance is None: distance = Euclidean
-    if initial_centeroids is None:
-        ids = np.random.randint(0, data_size, k)
-        centeroids = data[ids, :]
-    else:
-        centeroids = initial_centeroids
-    
-    prev_diff = 0x7fffffff
-    diff = prev_diff / 2
-    iter_ = 0
-    while abs(diff - prev_diff) > iteration_threshold and iter_ < max_iteration:
-        iter_ += 1
-        prev_diff = diff
-        group_ids, diff = update_group_index(data, centeroids)
-        if verbose: print 'iteration', iter_, 'loss = ', diff
-        if stop_at_local_minimum and diff > prev_diff: break
-        update_centeroids(data, centeroids, group_ids)
-    
+            if ids.size > 0: centeroids[i, :] = np.sum(data[ids, :], 0) / ids.size
     return centeroids, group_ids
 
+def _kmeans_benchmark(sizes=(10**4, 10**5, 10**6, 10**7), k=8, dim=3, max_iteration=5, loop_max_size=10**4):
+    '''time a fixed number of k-means iterations of the vectorized engine against the per-point loops
+    the loop implementation is skipped for sizes above loop_max_size, as it takes minutes per iteration
+    '''
+    import time
+    import numpy as np
+    for size in sizes:
+        data = np.random.random((size, dim)).astype(np.float32)
+        init = data[np.random.randint(0, size, k)]
+        start = time.time()
+        kmeans(data, k, initial_centeroids=init, iteration_threshold=-1, max_iteration=max_iteration)
+        t_vec = time.time() - start
+        if size <= loop_max_size:
+            start = time.time()
+            _kmeans_loop(data, k, init, max_iteration)
+            t_loop = time.time() - start
+            print('N = {:>9d}: vectorized {:.3f} s, loops {:.3f} s, speedup {:.0f}x'.format(size, t_vec, t_loop, t_loop / t_vec))
+        else:
+            print('N = {:>9d}: vectorized {:.3f} s, loops skipped'.format(size, t_vec))
+
+def _kmeans_accelerated_benchmark(size=10**5, ks=(16, 64, 256), dim=3, max_iteration=100):
+    '''compare distance evaluations and wall time of lloyd and hamerly from the same k-means++ seeds
+    lloyd runs until no assignment changes as well, so that both algorithms reach the same solution
+    '''
+    import time
+    import numpy as np
+    data = np.random.random((size, dim))
+    data_sq = np.einsum('ij,ij->i', data, data)
+    for k in ks:
+        init = _kmeanspp_init(data, k, np.random.RandomState(0), data_sq=data_sq)
+        for name in ('lloyd', 'hamerly'):
+            stats = {}
+            start = time.time()
+            _KMEANS_ALGORITHMS[name](data, k, init, np.random.RandomState(0), iteration_threshold=0, max_iteration=max_iteration,
+                                     stop_at_local_minimum=False, verbose=False, pairwise_distance=None, chunk_size=None,
+                                     data_sq=data_sq, stats=stats)
+            print('k = {:>4d} {:>8s}: {:>4d} iterations, {:>12d} distance evaluations, {:.3f} s'.format(
+                k, name, stats['iterations'], stats['distance_evaluations'], time.time() - start))
 
 def _kmeans_demo():
     import numpy as np
@@ -76,7 +512,7 @@ def _kmeans_demo():
     k = 4
     color = 'rgbc'
     centeroids, group_ids = kmeans(data, k, verbose=True)
-    for i in xrange(k):
+    for i in range(k):
         ids = np.where(group_ids == i)[0]
         x = data[ids, :]
         plt.plot(x[:,0], x[:,1], color[i] + '.', markersize=5)
@@ -84,5 +520,10 @@ def _kmeans_demo():
     plt.show()
 
 if __name__ == '__main__':
-    _kmeans_demo()
-
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        _kmeans_benchmark()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'benchmark_accelerated':
+        _kmeans_accelerated_benchmark()
+    else:
+        _kmeans_demo()
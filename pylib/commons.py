@@ -94,6 +94,18 @@ def wait_for_key_input(prompt='', valid_keys=['']):
         else: print('Valid keys are ' + str(valid_keys))
     return key
 
+def spawn_rngs(seed, n):
+    '''make n statistically independent random streams, e.g. one per data loading worker
+    seed: int, or None for fresh entropy from the OS
+    returns: list of np.random.Generator spawned from np.random.SeedSequence(seed) (numpy >= 1.17),
+             or of np.random.RandomState seeded by (seed, i) on older numpy
+    '''
+    import numpy as np
+    if hasattr(np.random, 'SeedSequence'):
+        return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n)]
+    if seed is None: seed = np.random.RandomState().randint(0, 0x7fffffff)
+    return [np.random.RandomState([seed, i]) for i in range(n)]
+
 def simple_logger():
     '''return a simple logger registered with a StreamHandler
     '''
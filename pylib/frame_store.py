@@ -0,0 +1,178 @@
+# coding=utf-8
+
+# ---------------------------------
+# Packs many point cloud files into one memory-mapped frame store
+#
+# A frame store <prefix> consists of
+#   <prefix>.data:       all frames concatenated, raw rows of C values of one dtype
+#   <prefix>.index.npz:  offsets (F+1 rows), names (source file of every frame), dtype, fields
+# FrameStore(prefix)[i] returns frame i as a zero-copy NixC view of the mapped file,
+# so random access is O(1) and the page cache does the caching.
+#
+# Usage: python frame_store.py root_dir prefix [--exts EXTS] [--fields FIELDS] [--dtype DTYPE]
+#
+# exts:   extensions of the files to pack, .pcd, .npy and .pkl are supported. Default: .pcd
+# fields: PCD fields to pack as channels. Default: all scalar fields of the first PCD file
+# dtype:  dtype of the packed values. Default: float32
+#
+# Example: python frame_store.py /data/pcd /data/train --exts .pcd --fields x y z intensity
+# ---------------------------------
+
+import os
+import argparse
+import numpy as np
+
+from commons import generate_files_within_dir, pickle_from_file, assure_dir
+
+class FrameStoreWriter(object):
+    """
+    Appends frames to a frame store. Use as a context manager, or call close() to write the index
+    """
+    def __init__(self, prefix, dtype=np.float32, fields=None):
+        """
+        prefix: str, output files are prefix.data and prefix.index.npz
+        dtype: dtype of the stored values, frames are converted to it
+        fields: optional list of channel names, stored with the index
+        """
+        assure_dir(os.path.dirname(prefix))
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        self.fields = fields
+        self.num_channels = None if fields is None else len(fields)
+        self.offsets = [0]
+        self.names = []
+        self._data_file = open(prefix + '.data', 'wb')
+
+    def append(self, frame, name=''):
+        """frame: NxC array. name: str, e.g. the source file name"""
+        frame = np.asarray(frame)
+        if frame.ndim == 1: frame = frame[:, None]
+        if self.num_channels is None: self.num_channels = frame.shape[1]
+        assert frame.shape[1] == self.num_channels, 'frame {} has {} channels, expected {}'.format(name, frame.shape[1], self.num_channels)
+        self._data_file.write(np.ascontiguousarray(frame, dtype=self.dtype).tobytes())
+        self.offsets.append(self.offsets[-1] + frame.shape[0])
+        self.names.append(name)
+
+    def close(self):
+        if self._data_file is None: return
+        self._data_file.close()
+        self._data_file = None
+        np.savez(self.prefix + '.index.npz', offsets=np.array(self.offsets, dtype=np.int64), names=np.array(self.names, dtype=np.str_),
+                 dtype=np.array(self.dtype.str), num_channels=np.array(self.num_channels or 0),
+                 fields=np.array(self.fields or [], dtype=np.str_))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FrameStore(object):
+    """
+    Read-only random access to the frames of a frame store
+
+    Usage:
+        store = FrameStore('/data/train')
+        pc = store[i]          # NixC view, no copy
+        len(store), store.names[i], store.index_of('/data/pcd/000001.pcd')
+
+    The mapping is opened lazily, so a store created before forking data loading workers is mapped by each worker.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        index = np.load(prefix + '.index.npz')
+        self.offsets = index['offsets']
+        self.names = [str(n) for n in index['names']]
+        self.dtype = np.dtype(str(index['dtype']))
+        self.num_channels = int(index['num_channels'])
+        self.fields = [str(f) for f in index['fields']] or None
+        self._data = None
+        self._name_to_index = None
+
+    @property
+    def data(self):
+        """all frames as one TxC memory-mapped array"""
+        if self._data is None:
+            total = int(self.offsets[-1])
+            if total == 0: self._data = np.zeros((0, self.num_channels), dtype=self.dtype)
+            else: self._data = np.memmap(self.prefix + '.data', dtype=self.dtype, mode='r', shape=(total, self.num_channels))
+        return self._data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """frame i as a NixC view of the mapped file"""
+        if i < 0: i += len(self)
+        return self.data[self.offsets[i]:self.offsets[i+1]]
+
+    def num_points(self, i):
+        return int(self.offsets[i+1] - self.offsets[i])
+
+    def index_of(self, name):
+        """frame index of a source file name"""
+        if self._name_to_index is None:
+            self._name_to_index = dict((n, i) for i, n in enumerate(self.names))
+        return self._name_to_index[name]
+
+    def __getstate__(self):
+        # the mapping is not pickled, it is reopened on first access
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+def load_frame(file_, fields=None):
+    """
+    load one point cloud file as an NxC array
+    .pcd: the given fields (default all scalar fields) as channels. .npy: the array. .pkl: the pickled array, or the first item of a (data, label) tuple
+    """
+    ext = os.path.splitext(file_)[1].lower()
+    if ext == '.pcd':
+        import pcd
+        data = pcd.read_pcd(file_)
+        if fields is None: fields = [n for n in data.dtype.names if data.dtype.fields[n][0].shape == ()]
+        frame = np.empty((data.shape[0], len(fields)), dtype=np.result_type(*[data.dtype.fields[f][0] for f in fields]))
+        for c, f in enumerate(fields): frame[:, c] = data[f]
+        return frame
+    if ext == '.npy':
+        return np.load(file_)
+    if ext == '.pkl':
+        frame = pickle_from_file(file_)
+        return frame[0] if isinstance(frame, tuple) else frame
+    raise ValueError('unsupported point cloud file: {}'.format(file_))
+
+def build_frame_store(files, prefix, fields=None, dtype=np.float32, verbose=False):
+    """
+    pack files into the frame store prefix, frames are stored in the order of files
+    files: iterable of file names, e.g. sorted(generate_files_within_dir(root_dir, ['.pcd']))
+    fields: PCD fields to pack, default all scalar fields of the first PCD file
+    returns: FrameStore
+    """
+    with FrameStoreWriter(prefix, dtype, fields) as writer:
+        for i, file_ in enumerate(files):
+            if writer.fields is None and file_.lower().endswith('.pcd'):
+                import pcd
+                header = pcd.read_pcd_header(file_)
+                writer.fields = [f for f, c in zip(header['fields'], header['count']) if c == 1]
+                writer.num_channels = len(writer.fields)
+            writer.append(load_frame(file_, writer.fields), file_)
+            if verbose and (i + 1) % 1000 == 0: print('{} frames packed'.format(i + 1))
+    return FrameStore(prefix)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root_dir', help='directory of point cloud files, searched recursively')
+    parser.add_argument('prefix', help='output frame store, writes prefix.data and prefix.index.npz')
+    parser.add_argument('--exts', nargs='+', help='extensions of the files to pack', default=['.pcd'])
+    parser.add_argument('--fields', nargs='+', help='PCD fields to pack', default=None)
+    parser.add_argument('--dtype', help='dtype of the packed values', default='float32')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    files = sorted(generate_files_within_dir(args.root_dir, args.exts))
+    print('>> Packing {} files from {} into {}'.format(len(files), args.root_dir, args.prefix))
+    store = build_frame_store(files, args.prefix, args.fields, args.dtype, verbose=True)
+    print('>> {} frames, {} points, {} channels of {}'.format(len(store), store.offsets[-1], store.num_channels, store.dtype))
@@ -0,0 +1,219 @@
+'''
+PCD (point cloud library) file reader and writer in pure numpy
+supports DATA ascii, binary and binary_compressed. Points are returned as numpy structured arrays, one field per PCD field
+'''
+
+import numpy as np
+
+# PCD TYPE, SIZE <-> numpy dtype
+_PCD_TO_NUMPY = {('F', 4): np.float32, ('F', 8): np.float64,
+                 ('I', 1): np.int8, ('I', 2): np.int16, ('I', 4): np.int32, ('I', 8): np.int64,
+                 ('U', 1): np.uint8, ('U', 2): np.uint16, ('U', 4): np.uint32, ('U', 8): np.uint64}
+_NUMPY_TO_PCD = dict((np.dtype(v).newbyteorder('<').str, k) for k, v in _PCD_TO_NUMPY.items())
+
+def _parse_header(f):
+    """read header lines up to and including DATA. Returns header dict and the byte offset of the data"""
+    header = {}
+    while True:
+        line = f.readline()
+        if not line: raise ValueError('invalid PCD file: no DATA line')
+        line = line.decode('ascii').strip()
+        if not line or line.startswith('#'): continue
+        key, _, value = line.partition(' ')
+        header[key.lower()] = value.split()
+        if key.upper() == 'DATA': break
+    fields = header['fields']
+    n = len(fields)
+    header['size'] = [int(x) for x in header.get('size', ['4'] * n)]
+    header['type'] = header.get('type', ['F'] * n)
+    header['count'] = [int(x) for x in header.get('count', ['1'] * n)]
+    header['width'] = int(header['width'][0])
+    header['height'] = int(header.get('height', ['1'])[0])
+    header['points'] = int(header.get('points', [header['width'] * header['height']])[0])
+    header['data'] = header['data'][0].lower()
+    return header, f.tell()
+
+def pcd_dtype(header):
+    """numpy structured dtype of the points described by a PCD header. Fields named '_' (padding) are kept as is"""
+    names, formats = [], []
+    for i, (name, t, size, count) in enumerate(zip(header['fields'], header['type'], header['size'], header['count'])):
+        names.append(name if name not in names else '{}_{}'.format(name, i))
+        base = np.dtype(_PCD_TO_NUMPY[(t.upper(), size)])
+        formats.append(base if count == 1 else (base, (count,)))
+    return np.dtype({'names': names, 'formats': formats})
+
+def read_pcd_header(filename):
+    """returns: dict with keys fields, size, type, count, width, height, points, data (lowercase format), viewpoint, version"""
+    with open(filename, 'rb') as f:
+        return _parse_header(f)[0]
+
+def lzf_decompress(data, expected_size):
+    """LZF decompression, as used by binary_compressed PCD. Uses the lzf module if installed"""
+    try:
+        import lzf
+        return lzf.decompress(bytes(data), expected_size)
+    except ImportError:
+        pass
+    data = bytearray(data)
+    out = bytearray(expected_size)
+    ip, op, n = 0, 0, len(data)
+    while ip < n:
+        ctrl = data[ip]
+        ip += 1
+        if ctrl < 32:
+            # literal run of ctrl + 1 bytes
+            length = ctrl + 1
+            out[op:op+length] = data[ip:ip+length]
+            ip += length
+            op += length
+        else:
+            # back reference
+            length = ctrl >> 5
+            if length == 7:
+                length += data[ip]
+                ip += 1
+            ref = op - ((ctrl & 0x1f) << 8) - data[ip] - 1
+            ip += 1
+            length += 2
+            if ref + length <= op:
+                out[op:op+length] = out[ref:ref+length]
+            else:
+                # overlapping copy repeats the referenced bytes
+                for i in range(length): out[op+i] = out[ref+i]
+            op += length
+    if op != expected_size: raise ValueError('LZF decompression size mismatch: {} != {}'.format(op, expected_size))
+    return bytes(out)
+
+def lzf_compress(data):
+    """
+    LZF compression. Uses the lzf module if installed,
+    otherwise emits literal runs only, which any LZF decoder reads but which is 1/32 larger than the input
+    """
+    data = bytes(data)
+    try:
+        import lzf
+        compressed = lzf.compress(data)
+        if compressed is not None: return compressed
+    except ImportError:
+        pass
+    buf = np.frombuffer(data, dtype=np.uint8)
+    n = buf.size
+    num_runs = (n + 31) // 32
+    out = np.empty(n + num_runs, dtype=np.uint8)
+    run_starts = np.arange(num_runs) * 32
+    # every run of 32 bytes is preceded by a control byte 31, the last run may be shorter
+    positions = np.arange(n) + np.arange(n) // 32 + 1
+    out[positions] = buf
+    out[run_starts + np.arange(num_runs)] = 31
+    if num_runs > 0: out[(num_runs - 1) * 33] = n - (num_runs - 1) * 32 - 1
+    return out.tobytes()
+
+def read_pcd(filename, mmap=False):
+    """
+    read a PCD file
+    filename: str
+    mmap: for DATA binary, map the file instead of reading it. The returned array is then a read-only view of the file
+    returns: structured ndarray of length POINTS, e.g. data['x'], data['intensity']
+    """
+    with open(filename, 'rb') as f:
+        header, offset = _parse_header(f)
+        dtype = pcd_dtype(header)
+        num_points = header['points']
+        fmt = header['data']
+        if fmt == 'binary' and mmap:
+            return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(num_points,))
+        if fmt == 'binary':
+            # readinto a bytearray keeps the result writable without an extra copy
+            buf = bytearray(num_points * dtype.itemsize)
+            if f.readinto(buf) != len(buf): raise ValueError('truncated PCD file: {}'.format(filename))
+            return np.frombuffer(buf, dtype=dtype, count=num_points)
+        if fmt == 'binary_compressed':
+            compressed_size, uncompressed_size = np.frombuffer(f.read(8), dtype='<u4')
+            buf = lzf_decompress(f.read(int(compressed_size)), int(uncompressed_size))
+            # stored field by field (column major)
+            data = np.empty(num_points, dtype=dtype)
+            pos = 0
+            for name in dtype.names:
+                field = dtype.fields[name][0]
+                data[name] = np.frombuffer(buf, dtype=field.base, count=num_points * max(1, int(np.prod(field.shape))),
+                                           offset=pos).reshape((num_points,) + field.shape)
+                pos += num_points * field.itemsize
+            return data
+        if fmt == 'ascii':
+            values = np.array(f.read().split(), dtype=np.float64)
+            values = values.reshape(num_points, sum(header['count']))
+            data = np.empty(num_points, dtype=dtype)
+            col = 0
+            for name, count in zip(dtype.names, header['count']):
+                data[name] = values[:, col] if count == 1 else values[:, col:col+count]
+                col += count
+            return data
+        raise ValueError('unsupported PCD DATA format: {}'.format(fmt))
+
+def to_structured(**fields):
+    """
+    structured array from named per point arrays, keeping their dtypes
+    e.g. to_structured(x=pc[:,0], y=pc[:,1], z=pc[:,2], intensity=intensity)
+    fields are ordered x, y, z first, then the others sorted by name
+    """
+    names = [n for n in ('x', 'y', 'z') if n in fields]
+    names += sorted(n for n in fields if n not in names)
+    arrays = [np.asarray(fields[n]) for n in names]
+    dtype = np.dtype([(n, a.dtype, a.shape[1:]) for n, a in zip(names, arrays)])
+    data = np.empty(arrays[0].shape[0], dtype=dtype)
+    for n, a in zip(names, arrays): data[n] = a
+    return data
+
+def write_pcd(filename, data, fmt='binary', viewpoint=(0, 0, 0, 1, 0, 0, 0)):
+    """
+    write a PCD file
+    data: structured ndarray, every field becomes a PCD field with its dtype, see to_structured
+    fmt: 'ascii', 'binary' or 'binary_compressed'
+    """
+    dtype = data.dtype
+    types, sizes, counts = [], [], []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        key = _NUMPY_TO_PCD.get(field.base.newbyteorder('<').str)
+        if key is None: raise ValueError('unsupported dtype of field {}: {}'.format(name, field))
+        types.append(key[0])
+        sizes.append(str(key[1]))
+        counts.append(str(max(1, int(np.prod(field.shape)))))
+    num_points = data.shape[0]
+    header = ['# .PCD v0.7 - Point Cloud Data file format',
+              'VERSION 0.7',
+              'FIELDS ' + ' '.join(dtype.names),
+              'SIZE ' + ' '.join(sizes),
+              'TYPE ' + ' '.join(types),
+              'COUNT ' + ' '.join(counts),
+              'WIDTH {}'.format(num_points),
+              'HEIGHT 1',
+              'VIEWPOINT ' + ' '.join(str(v) for v in viewpoint),
+              'POINTS {}'.format(num_points),
+              'DATA ' + fmt]
+    # packed little-endian records without padding
+    packed = np.dtype({'names': dtype.names, 'formats': [dtype.fields[n][0].newbyteorder('<') for n in dtype.names]})
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        if fmt == 'binary':
+            records = np.empty(num_points, dtype=packed)
+            for name in dtype.names: records[name] = data[name]
+            f.write(records.tobytes())
+        elif fmt == 'binary_compressed':
+            columns = b''.join(np.ascontiguousarray(data[name], dtype=packed.fields[name][0].base).tobytes() for name in dtype.names)
+            compressed = lzf_compress(columns)
+            f.write(np.array([len(compressed), len(columns)], dtype='<u4').tobytes())
+            f.write(compressed)
+        elif fmt == 'ascii':
+            columns = [np.asarray(data[name], dtype=np.float64).reshape(num_points, int(c)) for name, c in zip(dtype.names, counts)]
+            formats = ['%.8g' if t == 'F' else '%d' for t, c in zip(types, columns) for _ in range(c.shape[1])]
+            np.savetxt(f, np.hstack(columns), fmt=formats, delimiter=' ')
+        else:
+            raise ValueError('unsupported PCD DATA format: {}'.format(fmt))
+
+def xyz(data, dtype=None):
+    """Nx3 array of fields x, y, z of a structured array, in their own dtype unless dtype is given"""
+    dtype = dtype or data.dtype.fields['x'][0]
+    pc = np.empty((data.shape[0], 3), dtype=dtype)
+    pc[:, 0], pc[:, 1], pc[:, 2] = data['x'], data['y'], data['z']
+    return pc
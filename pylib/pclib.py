@@ -1,6 +1,15 @@
 import numpy as np
 
 
+def _get_rng(rng):
+    """
+    Random number source of the augmentations: the global np.random state if rng is None,
+    otherwise rng itself. Only methods shared by np.random.Generator and np.random.RandomState are used:
+    uniform, standard_normal and shuffle. Use commons.spawn_rngs to make independent streams for workers
+    """
+    return np.random if rng is None else rng
+
+
 #################################
 # point cloud transformation
 #################################
@@ -18,136 +27,215 @@ def normalize_point_cloud(pc):
     pc = pc / m
     return pc
 
-def rotate_point_cloud_y(batch_data):
+def normalize_point_cloud_batch(batch_data, mask=None, out=None):
+    """
+    Normalize every point cloud of a batch: shift the xyz centroid to the origin and scale the farthest point to distance 1
+    Channels beyond xyz are copied unchanged, and the dtype is kept if it is floating point
+    Input:
+      BxNxC array, batch_data
+      BxN bool array, mask, optional, only valid points count for the centroid and the scale.
+        Invalid (e.g. padded) points are transformed along with the valid ones
+      BxNxC array, out, optional output buffer, may be batch_data itself to normalize in place
+    Return:
+      BxNxC array, normalized batch_data
+    """
+    if out is None:
+        dtype = batch_data.dtype if np.issubdtype(batch_data.dtype, np.floating) else np.float32
+        out = np.empty(batch_data.shape, dtype=dtype)
+    if out is not batch_data: out[...] = batch_data
+    xyz = out[..., :3]
+    if mask is None:
+        centroid = np.mean(xyz, axis=1, keepdims=True)
+    else:
+        weights = mask.astype(out.dtype)
+        count = np.maximum(np.sum(weights, axis=1), 1)
+        centroid = np.matmul(weights[:, None, :], xyz) / count[:, None, None]
+    xyz -= centroid
+    sq_norms = np.einsum('bnc,bnc->bn', xyz, xyz)
+    if mask is not None: sq_norms[~mask] = 0
+    m = np.sqrt(np.max(sq_norms, axis=1))
+    m[m == 0] = 1
+    xyz /= m[:, None, None]
+    return out
+
+def rotation_matrices_x(angles):
+    """
+    Rotation matrices around x axis, to be right-multiplied to row vectors of points
+    Input:
+      B array, rotation angles
+    Return:
+      Bx3x3 array
+    """
+    cosval, sinval = np.cos(angles), np.sin(angles)
+    R = np.zeros((len(angles), 3, 3))
+    R[:, 0, 0] = 1
+    R[:, 1, 1] = cosval
+    R[:, 1, 2] = -sinval
+    R[:, 2, 1] = sinval
+    R[:, 2, 2] = cosval
+    return R
+
+def rotation_matrices_y(angles):
+    """
+    Rotation matrices around y axis, to be right-multiplied to row vectors of points
+    Input:
+      B array, rotation angles
+    Return:
+      Bx3x3 array
+    """
+    cosval, sinval = np.cos(angles), np.sin(angles)
+    R = np.zeros((len(angles), 3, 3))
+    R[:, 0, 0] = cosval
+    R[:, 0, 2] = sinval
+    R[:, 1, 1] = 1
+    R[:, 2, 0] = -sinval
+    R[:, 2, 2] = cosval
+    return R
+
+def rotation_matrices_z(angles):
+    """
+    Rotation matrices around z axis, to be right-multiplied to row vectors of points
+    Input:
+      B array, rotation angles
+    Return:
+      Bx3x3 array
+    """
+    cosval, sinval = np.cos(angles), np.sin(angles)
+    R = np.zeros((len(angles), 3, 3))
+    R[:, 0, 0] = cosval
+    R[:, 0, 1] = -sinval
+    R[:, 1, 0] = sinval
+    R[:, 1, 1] = cosval
+    R[:, 2, 2] = 1
+    return R
+
+def rotate_batch(batch_data, R):
+    """
+    Apply per shape rotation matrices to the xyz channels of a batch, other channels are copied
+    Input:
+      BxNxC array, original batch of point clouds, C >= 3
+      Bx3x3 array, rotation matrices, right-multiplied to the points
+    Return:
+      BxNxC array, rotated batch of point clouds, same dtype as the input if it is floating point, otherwise float32
+    """
+    dtype = batch_data.dtype if np.issubdtype(batch_data.dtype, np.floating) else np.float32
+    rotated_data = np.empty(batch_data.shape, dtype=dtype)
+    np.matmul(batch_data[..., :3], R.astype(dtype, copy=False), out=rotated_data[..., :3])
+    rotated_data[..., 3:] = batch_data[..., 3:]
+    return rotated_data
+
+def rotate_point_cloud_y(batch_data, rng=None):
     """
     Randomly rotate the point clouds around y axis to augument the dataset
     rotation is per shape based along up direction
     Input:
-      BxNx3 array, original batch of point clouds
+      BxNxC array, original batch of point clouds
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Return:
-      BxNx3 array, rotated batch of point clouds
-    """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in xrange(batch_data.shape[0]):
-        rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, 0, sinval],
-                                    [0, 1, 0],
-                                    [-sinval, 0, cosval]])
-        shape_pc = batch_data[k, ...]
-        rotated_data[k, ...] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-    return rotated_data
+      BxNxC array, rotated batch of point clouds
+    """
+    rng = _get_rng(rng)
+    rotation_angles = rng.uniform(size=batch_data.shape[0]) * 2 * np.pi
+    return rotate_batch(batch_data, rotation_matrices_y(rotation_angles))
 
-def rotate_point_cloud_z(batch_data):
+def rotate_point_cloud_z(batch_data, rng=None):
     """
     Randomly rotate the point clouds around z axis to augument the dataset
     rotation is per shape based along up direction
     Input:
-      BxNx3 array, original batch of point clouds
+      BxNxC array, original batch of point clouds
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Return:
-      BxNx3 array, rotated batch of point clouds
-    """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in xrange(batch_data.shape[0]):
-        rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, -sinval, 0],
-                                    [sinval, cosval, 0],
-                                    [0, 0, 1]])
-        shape_pc = batch_data[k, ...]
-        rotated_data[k, ...] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-    return rotated_data
+      BxNxC array, rotated batch of point clouds
+    """
+    rng = _get_rng(rng)
+    rotation_angles = rng.uniform(size=batch_data.shape[0]) * 2 * np.pi
+    return rotate_batch(batch_data, rotation_matrices_z(rotation_angles))
 
 def rotate_point_cloud_by_angle(batch_data, rotation_angle):
     """
     Rotate the point cloud along up direction with certain angle.
     Input:
-      BxNx3 array, original batch of point clouds
+      BxNxC array, original batch of point clouds
     Return:
-      BxNx3 array, rotated batch of point clouds
-    """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in xrange(batch_data.shape[0]):
-        #rotation_angle = np.random.uniform() * 2 * np.pi
-        cosval = np.cos(rotation_angle)
-        sinval = np.sin(rotation_angle)
-        rotation_matrix = np.array([[cosval, 0, sinval],
-                                    [0, 1, 0],
-                                    [-sinval, 0, cosval]])
-        shape_pc = batch_data[k,:,0:3]
-        rotated_data[k,:,0:3] = np.dot(shape_pc.reshape((-1, 3)), rotation_matrix)
-    return rotated_data
+      BxNxC array, rotated batch of point clouds
+    """
+    rotation_angles = np.full(batch_data.shape[0], rotation_angle, dtype=np.float64)
+    return rotate_batch(batch_data, rotation_matrices_y(rotation_angles))
 
-def rotate_perturbation_point_cloud(batch_data, angle_sigma=0.06, angle_clip=0.18):
+def perturbation_rotation_matrices(angles):
+    """
+    Rotation matrices Rz * Ry * Rx, to be right-multiplied to row vectors of points
+    Input:
+      Bx3 array, rotation angles around x, y, z axes
+    Return:
+      Bx3x3 array
+    """
+    Rx = rotation_matrices_x(angles[:, 0])
+    Ry = rotation_matrices_y(angles[:, 1])
+    Rz = rotation_matrices_z(angles[:, 2])
+    return np.matmul(Rz, np.matmul(Ry, Rx))
+
+def rotate_perturbation_point_cloud(batch_data, angle_sigma=0.06, angle_clip=0.18, rng=None):
     """
     Randomly perturb the point clouds by small rotations
     Input:
-      BxNx3 array, original batch of point clouds
+      BxNxC array, original batch of point clouds
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Return:
-      BxNx3 array, rotated batch of point clouds
-    """
-    rotated_data = np.zeros(batch_data.shape, dtype=np.float32)
-    for k in xrange(batch_data.shape[0]):
-        angles = np.clip(angle_sigma*np.random.randn(3), -angle_clip, angle_clip)
-        Rx = np.array([[1,0,0],
-                       [0,np.cos(angles[0]),-np.sin(angles[0])],
-                       [0,np.sin(angles[0]),np.cos(angles[0])]])
-        Ry = np.array([[np.cos(angles[1]),0,np.sin(angles[1])],
-                       [0,1,0],
-                       [-np.sin(angles[1]),0,np.cos(angles[1])]])
-        Rz = np.array([[np.cos(angles[2]),-np.sin(angles[2]),0],
-                       [np.sin(angles[2]),np.cos(angles[2]),0],
-                       [0,0,1]])
-        R = np.dot(Rz, np.dot(Ry,Rx))
-        shape_pc = batch_data[k, ...]
-        rotated_data[k, ...] = np.dot(shape_pc.reshape((-1, 3)), R)
-    return rotated_data
+      BxNxC array, rotated batch of point clouds
+    """
+    rng = _get_rng(rng)
+    angles = np.clip(angle_sigma*rng.standard_normal(size=(batch_data.shape[0], 3)), -angle_clip, angle_clip)
+    return rotate_batch(batch_data, perturbation_rotation_matrices(angles))
 
-def jitter_point_cloud(batch_data, sigma=0.01, clip=0.05):
+def jitter_point_cloud(batch_data, sigma=0.01, clip=0.05, rng=None):
     """
     Randomly jitter points. jittering is per point.
     Input:
       BxNx3 array, original batch of point clouds
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Return:
       BxNx3 array, jittered batch of point clouds
     """
+    rng = _get_rng(rng)
     B, N, C = batch_data.shape
     assert(clip > 0)
-    jittered_data = np.clip(sigma * np.random.randn(B, N, C), -1*clip, clip)
+    jittered_data = np.clip(sigma * rng.standard_normal(size=(B, N, C)), -1*clip, clip)
     jittered_data += batch_data
     return jittered_data
 
-def shift_point_cloud(batch_data, shift_range=0.1):
+def shift_point_cloud(batch_data, shift_range=0.1, rng=None):
     """
-    Randomly shift point cloud. Shift is per point cloud.
+    Randomly shift point cloud in place. Shift is per point cloud, only xyz channels are shifted.
     Input:
-      BxNx3 array, original batch of point clouds
+      BxNxC array, original batch of point clouds
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Return:
-      BxNx3 array, shifted batch of point clouds
+      BxNxC array, shifted batch of point clouds
     """
+    rng = _get_rng(rng)
     B, N, C = batch_data.shape
-    shifts = np.random.uniform(-shift_range, shift_range, (B,3))
-    for batch_index in range(B):
-        batch_data[batch_index,:,:] += shifts[batch_index,:]
+    shifts = rng.uniform(-shift_range, shift_range, (B,3))
+    batch_data[:,:,:3] += shifts[:,None,:].astype(batch_data.dtype, copy=False)
     return batch_data
 
-def random_scale_point_cloud(batch_data, scale_low=0.8, scale_high=1.25):
+def random_scale_point_cloud(batch_data, scale_low=0.8, scale_high=1.25, rng=None):
     """
-    Randomly scale the point cloud. Scale is per point cloud.
+    Randomly scale the point cloud in place. Scale is per point cloud, only xyz channels are scaled.
     Input:
-      BxNx3 array, original batch of point clouds
+      BxNxC array, original batch of point clouds
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Return:
-      BxNx3 array, scaled batch of point clouds
+      BxNxC array, scaled batch of point clouds
     """
+    rng = _get_rng(rng)
     B, N, C = batch_data.shape
-    scales = np.random.uniform(scale_low, scale_high, B)
-    for batch_index in range(B):
-        batch_data[batch_index,:,:] *= scales[batch_index]
+    scales = rng.uniform(scale_low, scale_high, B)
+    batch_data[:,:,:3] *= scales[:,None,None].astype(batch_data.dtype, copy=False)
     return batch_data
 
-def shuffle_points(batch_data, batch_label=None):
+def shuffle_points(batch_data, batch_label=None, rng=None):
     """
     Shuffle orders of points in each point cloud -- changes FPS behavior.
     Use the same shuffling idx for the entire batch.
@@ -155,25 +243,28 @@ def shuffle_points(batch_data, batch_label=None):
     Input:
       BxNxC array, batch_data
       BxN array, batch_label, optional
+      rng, optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
     Output:
       BxNxC array, shuffled batch_data
       BxN, shuffled batch_label, if it is present
     """
     idx = np.arange(batch_data.shape[1])
-    np.random.shuffle(idx)
+    _get_rng(rng).shuffle(idx)
     if batch_label is None:
         return batch_data[:,idx,:]
     else:
         return batch_data[:,idx,:], batch_label[:,idx]
 
-def random_point_dropout(batch_pc, labels=None, max_dropout_ratio=0.875):
+def random_point_dropout(batch_pc, labels=None, max_dropout_ratio=0.875, rng=None):
     """
     batch_pc: BxNx3
     labels: [optional] BxN, per point label
+    rng: [optional] np.random.Generator or np.random.RandomState, defaults to the global np.random state
     """
+    rng = _get_rng(rng)
     for b in range(batch_pc.shape[0]):
-        dropout_ratio =  np.random.random()*max_dropout_ratio
-        drop_idx = np.where(np.random.random((batch_pc.shape[1]))<=dropout_ratio)[0]
+        dropout_ratio =  rng.uniform()*max_dropout_ratio
+        drop_idx = np.where(rng.uniform(size=batch_pc.shape[1])<=dropout_ratio)[0]
         if len(drop_idx)>0:
             batch_pc[b,drop_idx,:] = batch_pc[b,0,:] # set to the first point
             if labels is not None:
@@ -184,6 +275,174 @@ def random_point_dropout(batch_pc, labels=None, max_dropout_ratio=0.875):
         return batch_pc
 
 
+#######################################
+# augmentation pipeline
+#######################################
+
+def _affine_matrices(A=None, t=None):
+    """
+    Homogeneous transforms for row vectors, p' = [p, 1] * M = p * A + t
+    Input:
+      Bx3x3 array A, or None for identity
+      Bx3 array t, or None for no translation
+    Return:
+      Bx4x4 array
+    """
+    n = len(A) if A is not None else len(t)
+    M = np.zeros((n, 4, 4))
+    M[:, 3, 3] = 1
+    M[:, :3, :3] = np.eye(3) if A is None else A
+    if t is not None: M[:, 3, :3] = t
+    return M
+
+class AugmentationPipeline(object):
+    """
+    Composable augmentation for BxNxC point cloud batches
+    Consecutive affine transforms (rotations, scale, shift) are fused into a single 4x4 matrix per sample,
+    so the points are transformed once no matter how many of them are chained.
+
+    Usage:
+        pipeline = AugmentationPipeline(seed=0).rotate_z().rotate_perturbation().scale().shift().jitter()
+        batch_data = pipeline(batch_data)                      # new array
+        pipeline(batch_data, batch_label, out=batch_data)      # in place
+
+    With a seed, every sample draws from its own RandomState seeded by (seed, sample id), so the augmentation
+    of a sample does not depend on the batch it is in. Otherwise rng, or the global np.random state, is used.
+    """
+    AFFINE = ('rotate_y', 'rotate_z', 'rotate_by_angle', 'rotate_perturbation', 'scale', 'shift')
+
+    def __init__(self, seed=None, rng=None):
+        self.seed = seed
+        self.rng = _get_rng(rng)
+        self.transforms = []  # list of (name, kwargs)
+        self.num_samples = 0  # default sample ids continue from the number of samples augmented so far
+
+    def _add(self, name, **kwargs):
+        self.transforms.append((name, kwargs))
+        return self
+
+    def rotate_y(self):
+        """random rotation around y axis, see rotate_point_cloud_y"""
+        return self._add('rotate_y')
+
+    def rotate_z(self):
+        """random rotation around z axis, see rotate_point_cloud_z"""
+        return self._add('rotate_z')
+
+    def rotate_by_angle(self, rotation_angle):
+        """rotation around y axis with a fixed angle, see rotate_point_cloud_by_angle"""
+        return self._add('rotate_by_angle', rotation_angle=rotation_angle)
+
+    def rotate_perturbation(self, angle_sigma=0.06, angle_clip=0.18):
+        """small random rotation, see rotate_perturbation_point_cloud"""
+        return self._add('rotate_perturbation', angle_sigma=angle_sigma, angle_clip=angle_clip)
+
+    def scale(self, scale_low=0.8, scale_high=1.25):
+        """random per shape scale, see random_scale_point_cloud"""
+        return self._add('scale', scale_low=scale_low, scale_high=scale_high)
+
+    def shift(self, shift_range=0.1):
+        """random per shape shift, see shift_point_cloud"""
+        return self._add('shift', shift_range=shift_range)
+
+    def jitter(self, sigma=0.01, clip=0.05):
+        """random per point jitter of all channels, see jitter_point_cloud"""
+        assert(clip > 0)
+        return self._add('jitter', sigma=sigma, clip=clip)
+
+    def dropout(self, max_dropout_ratio=0.875):
+        """replace random points by the first point, see random_point_dropout"""
+        return self._add('dropout', max_dropout_ratio=max_dropout_ratio)
+
+    def shuffle(self):
+        """shuffle the order of points. Unlike shuffle_points, every sample gets its own permutation"""
+        return self._add('shuffle')
+
+    def _rngs(self, B, sample_ids):
+        if self.seed is None: return None
+        if sample_ids is None: sample_ids = np.arange(self.num_samples, self.num_samples + B)
+        return [np.random.RandomState([self.seed, int(i)]) for i in sample_ids]
+
+    def _draw(self, rngs, B, f):
+        """f(rng, n) draws an array with leading dimension n. Draw for the whole batch, or sample by sample"""
+        if rngs is None: return f(self.rng, B)
+        return np.concatenate([f(rng, 1) for rng in rngs])
+
+    def _affine(self, name, kwargs, rngs, B):
+        """Bx4x4 matrices of one affine transform"""
+        if name == 'rotate_y':
+            angles = self._draw(rngs, B, lambda rng, n: rng.uniform(size=n) * 2 * np.pi)
+            return _affine_matrices(A=rotation_matrices_y(angles))
+        if name == 'rotate_z':
+            angles = self._draw(rngs, B, lambda rng, n: rng.uniform(size=n) * 2 * np.pi)
+            return _affine_matrices(A=rotation_matrices_z(angles))
+        if name == 'rotate_by_angle':
+            return _affine_matrices(A=rotation_matrices_y(np.full(B, kwargs['rotation_angle'], dtype=np.float64)))
+        if name == 'rotate_perturbation':
+            sigma, clip = kwargs['angle_sigma'], kwargs['angle_clip']
+            angles = self._draw(rngs, B, lambda rng, n: np.clip(sigma * rng.standard_normal(size=(n, 3)), -clip, clip))
+            return _affine_matrices(A=perturbation_rotation_matrices(angles))
+        if name == 'scale':
+            scales = self._draw(rngs, B, lambda rng, n: rng.uniform(kwargs['scale_low'], kwargs['scale_high'], size=n))
+            return _affine_matrices(A=scales[:, None, None] * np.eye(3))
+        if name == 'shift':
+            r = kwargs['shift_range']
+            return _affine_matrices(t=self._draw(rngs, B, lambda rng, n: rng.uniform(-r, r, size=(n, 3))))
+        raise ValueError('unknown affine transform: {}'.format(name))
+
+    def __call__(self, batch_data, batch_label=None, sample_ids=None, out=None):
+        """
+        Input:
+          BxNxC array, batch_data, C >= 3
+          BxN array, batch_label, optional per point label, changed along with the points by dropout and shuffle
+          B array, sample_ids, optional ids to seed the per sample RandomState, defaults to a running counter
+          BxNxC array, out, optional preallocated output buffer, may be batch_data itself
+        Output:
+          BxNxC array, augmented batch_data, written to out if given
+          BxN array, augmented batch_label, if it is present. Modified in place if out is batch_data
+        """
+        B, N, C = batch_data.shape
+        inplace = out is batch_data
+        if out is None:
+            dtype = batch_data.dtype if np.issubdtype(batch_data.dtype, np.floating) else np.float32
+            out = np.empty(batch_data.shape, dtype=dtype)
+        if not inplace: out[...] = batch_data
+        if batch_label is not None and not inplace: batch_label = batch_label.copy()
+        rngs = self._rngs(B, sample_ids)
+        self.num_samples += B
+
+        M = None
+        for name, kwargs in self.transforms + [(None, None)]:
+            if name in self.AFFINE:
+                T = self._affine(name, kwargs, rngs, B)
+                M = T if M is None else np.matmul(M, T)
+                continue
+            if M is not None:
+                # apply the fused affine transforms once
+                M = M.astype(out.dtype, copy=False)
+                xyz = out[..., :3]
+                np.matmul(xyz, M[:, :3, :3], out=xyz)
+                xyz += M[:, None, 3, :3]
+                M = None
+            if name == 'jitter':
+                sigma, clip = kwargs['sigma'], kwargs['clip']
+                out += self._draw(rngs, B, lambda rng, n: np.clip(sigma * rng.standard_normal(size=(n, N, C)), -clip, clip))
+            elif name == 'dropout':
+                ratio = self._draw(rngs, B, lambda rng, n: rng.uniform(size=n)) * kwargs['max_dropout_ratio']
+                drop = self._draw(rngs, B, lambda rng, n: rng.uniform(size=(n, N))) <= ratio[:, None]
+                np.copyto(out, out[:, :1, :], where=drop[..., None])
+                if batch_label is not None: np.copyto(batch_label, batch_label[:, :1], where=drop)
+            elif name == 'shuffle':
+                idx = np.argsort(self._draw(rngs, B, lambda rng, n: rng.uniform(size=(n, N))), axis=1)
+                out[...] = np.take_along_axis(out, idx[..., None], axis=1)
+                if batch_label is not None: batch_label[...] = np.take_along_axis(batch_label, idx, axis=1)
+
+        if batch_label is None:
+            return out
+        else:
+            return out, batch_label
+
+
 #######################################
 # point cloud -> voxel
 #######################################
@@ -197,6 +456,7 @@ def point_cloud_label_to_surface_voxel_label(point_cloud, label, res=0.02):
     Output:
         uvidx: keep ids when converting to voxel, (M,)
         uvlabel: labels of the kept indices, (M,) or (M,2)
+    See voxel.VoxelGrid for integer voxel keys, per voxel centroids, majority labels and point to voxel maps.
     """
     coordmax = np.max(point_cloud, axis=0)
     coordmin = np.min(point_cloud, axis=0)
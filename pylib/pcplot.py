@@ -8,79 +8,349 @@ import numpy as np
 import matplotlib.pyplot as plt
 from mayavi import mlab
 
-def _plot_color(data, label, scale_factor, color={}):
+from sampling import random_subsample
+from voxel import voxel_coords, voxel_keys, group_keys
+
+# clouds larger than this are voxel-downsampled for display, see _level_of_detail
+MAX_DISPLAY_POINTS = 200000
+
+def _voxel_first(xyz, res):
+    """index of the first point in every occupied voxel of size res"""
+    coords, _ = voxel_coords(xyz, res)
+    keys, dims = voxel_keys(coords)
+    _, inverse, counts = group_keys(keys)
+    first = np.empty(counts.shape[0], dtype=np.int64)
+    # the first write of every voxel wins when assigning in reversed order
+    first[inverse[::-1]] = np.arange(xyz.shape[0] - 1, -1, -1)
+    return first
+
+def _level_of_detail(data, max_points, tolerance=0.95):
+    """
+    indices of at most max_points points of data, one per voxel
+    the voxel size is searched in both directions for the finest grid with at most max_points occupied voxels,
+    stopping once at least tolerance * max_points voxels are kept. Sparse clouds (e.g. LiDAR sweeps, outliers) get voxels
+    much smaller than their bounding box suggests
+    """
+    N = data.shape[0]
+    if max_points is None or N <= max_points:
+        return np.arange(N)
+    xyz = data[:, :3]
+    extent = float(np.max(np.ptp(xyz, axis=0)))
+    if extent == 0:
+        return np.arange(1)
+    # finest voxel size considered, keeps voxel keys well inside int64
+    min_res = extent / (1 << 20)
+    # coarse: a voxel size keeping at most max_points voxels
+    hi = extent / max_points ** (1. / 3)
+    first = _voxel_first(xyz, hi)
+    while first.shape[0] > max_points:
+        hi *= 2
+        first = _voxel_first(xyz, hi)
+    # fine: a voxel size keeping more than max_points voxels. Steps assume count ~ res^-2 (points on surfaces), then the measured slope
+    target = (1 + tolerance) / 2 * max_points
+    slope = 2.
+    n_lo = None
+    while first.shape[0] < tolerance * max_points and hi > min_res:
+        lo = max(hi * min(max((first.shape[0] / target) ** (1. / slope), 1. / 8), 1. / 1.5), min_res)
+        candidate = _voxel_first(xyz, lo)
+        if candidate.shape[0] > max_points:
+            n_lo = candidate.shape[0]
+            break
+        if candidate.shape[0] > first.shape[0]:
+            slope = min(max(np.log(float(candidate.shape[0]) / first.shape[0]) / np.log(hi / lo), 0.5), 3.)
+        hi, first = lo, candidate
+    # search between lo and hi, interpolating the voxel count on a log-log scale
+    for _ in range(30):
+        if n_lo is None or first.shape[0] >= tolerance * max_points or hi / lo < 1.001: break
+        t = np.log(float(n_lo) / target) / np.log(float(n_lo) / first.shape[0])
+        mid = lo * (hi / lo) ** min(max(t, 0.1), 0.9)
+        candidate = _voxel_first(xyz, mid)
+        if candidate.shape[0] > max_points:
+            lo, n_lo = mid, candidate.shape[0]
+        else:
+            hi, first = mid, candidate
+    return np.sort(first)
+
+def _points(data, scalars, scale_factor, mode, lut, vmin, vmax):
+    """one point actor colored by scalars through a lookup table. lut: Kx4 uint8 RGBA array"""
+    pts = mlab.points3d(data[:,0], data[:,1], data[:,2], scalars, mode=mode, scale_mode='none',
+                        scale_factor=scale_factor, vmin=vmin, vmax=vmax)
+    pts.glyph.color_mode = 'color_by_scalar'
+    pts.module_manager.scalar_lut_manager.lut.number_of_colors = lut.shape[0]
+    pts.module_manager.scalar_lut_manager.lut.table = lut
+    return pts
+
+def _rgba_table(colors):
+    """Kx3 floats in [0, 1] -> Kx4 uint8 lookup table"""
+    lut = np.full((len(colors), 4), 255, dtype=np.uint8)
+    lut[:, :3] = np.round(np.asarray(colors, dtype=np.float64) * 255)
+    return lut
+
+def _plot_color(data, label, scale_factor, color={}, mode='sphere'):
     if color == {}:
         color = {0: (0,1,1), 1: (1,0,0), 2: (1,1,0), 3: (0,1,0),
                  4: (0,0,1), 5: (1,0,1), 6: (0.4, 0.7, 0.6), 7: (0.5, 0, 0.6),
                  8: (0.99, 0.88, 0.55), 9: (0.96, 0.4, 0.3), 10: (0.6, 0, 0.2),
                  11: (0,1,0.8)}
-    all_label = np.unique(label)
+    all_label, scalars = np.unique(label, return_inverse=True)
+    colors = []
     for l in all_label:
-        x = data[label == l]
         c = color.get(l)
         if c is None:
             c = tuple(np.random.random(3))
-        mlab.points3d(x[:,0], x[:,1], x[:,2], color=c, scale_factor=scale_factor)
+        colors.append(c)
+    return _points(data, scalars.astype(np.float64), scale_factor, mode, _rgba_table(colors), 0, max(len(colors) - 1, 1))
+
+def _subsample(data, subsample, max_points, *values):
+    """random subsample of subsample points, then level of detail down to max_points. returns data, values"""
+    if subsample is not None and subsample < data.shape[0]:
+        ids = random_subsample(data.shape[0], subsample)
+        data = data[ids]
+        values = [v[ids] for v in values]
+    ids = _level_of_detail(data, max_points)
+    if ids.shape[0] < data.shape[0]:
+        data = data[ids]
+        values = [v[ids] for v in values]
+    return (data,) + tuple(values)
 
-def plot(data, subsample=None, size=1, title=''):
+def plot(data, subsample=None, size=1, title='', max_points=MAX_DISPLAY_POINTS, mode='sphere'):
     """
     data: Nx3 numpy array
     subsample: number of subsampled input point cloud
+    max_points: display budget, larger clouds are voxel-downsampled to at most max_points. None to show all points
+    mode: glyph of every point, 'sphere' or 'point' (fastest, size in pixels)
     """
-    if subsample is not None and subsample < data.shape[0]:
-        ids = np.random.choice(data.shape[0], subsample, replace=False)
-        data = data[ids]
-    mlab.points3d(data[:,0], data[:,1], data[:,2], scale_factor=0.01*size)
+    data, = _subsample(data, subsample, max_points)
+    mlab.points3d(data[:,0], data[:,1], data[:,2], mode=mode, scale_factor=0.01*size)
     if title:
         mlab.title(title)
     mlab.show()
 
-def plot_with_labels(data, label, subsample=None, size=1, color={}, title='', img=None, img_path=None):
+def plot_with_labels(data, label, subsample=None, size=1, color={}, title='', img=None, img_path=None,
+                     max_points=MAX_DISPLAY_POINTS, mode='sphere'):
     """
     data: Nx3 numpy array
     label: N, numpy array
     subsample: number of subsampled input point cloud
     size: size of points
     color: dict int->tuple(3)
+    max_points, mode: see plot
     """
     if img is not None:
-        img_path = os.path.join(os.environ['HOME'], 'tmp', 'tmp.jpg')
+        import tempfile
+        import cv2 as cv
+        fd, img_path = tempfile.mkstemp(suffix='.jpg', prefix='plot_')
+        os.close(fd)
         cv.imwrite(img_path, img)
     if img_path is not None:
         p = subprocess.Popen(['eog', img_path])
-    if subsample is not None and subsample < data.shape[0]:
-        ids = np.random.choice(data.shape[0], subsample, replace=False)
-        data = data[ids]
-        label = label[ids]
-    _plot_color(data, label, 0.01*size, color=color)
+    data, label = _subsample(data, subsample, max_points, label)
+    _plot_color(data, label, 0.01*size, color=color, mode=mode)
     if title:
         mlab.title(title)
     mlab.show()
     if img_path is not None:
         p.wait()
+    if img is not None:
+        os.remove(img_path)
 
-def plot_with_cmap(data, color, num_bins=10, subsample=None, size=1, title=''):
+def plot_with_cmap(data, color, num_bins=10, subsample=None, size=1, title='', max_points=MAX_DISPLAY_POINTS, mode='sphere'):
     """
     data: Nx3 numpy array
     color: N, numpy array
     num_bins: int, discretize color into num_bins bins
     subsample: int, number of subsampled input point cloud
+    max_points, mode: see plot
     """
-    if subsample is not None and subsample < data.shape[0]:
-        ids = np.random.choice(data.shape[0], subsample, replace=False)
-        data = data[ids]
-        color = color[ids]
     assert data.shape[0] == len(color)
+    data, color = _subsample(data, subsample, max_points, color)
     cmap = plt.cm.get_cmap('Spectral')
     c1, c2 = float(min(color)), float(max(color))
     color = (color-c1) / (c2-c1)
     EPS = 1e-4
     bins = np.linspace(-EPS, 1+EPS, num_bins+1)
-    for i in xrange(num_bins):
-        x = data[(color >= bins[i]) & (color < bins[i+1])]
-        c = cmap(1-bins[i])[:3]
-        mlab.points3d(x[:,0], x[:,1], x[:,2], color=c, scale_factor=0.01*size)
+    scalars = np.clip(np.searchsorted(bins, color, side='right') - 1, 0, num_bins - 1)
+    lut = _rgba_table([cmap(1-b)[:3] for b in bins[:-1]])
+    _points(data, scalars.astype(np.float64), 0.01*size, mode, lut, 0, num_bins - 1)
     if title:
         mlab.title(title)
     mlab.show()
 
+
+#########################################
+# long-lived viewer process
+#########################################
+
+def _viewer_loop(conn, title, colormap, size, delay):
+    """body of the viewer process: one point actor whose data is replaced whenever a new cloud arrives on conn"""
+    from pyface.api import GUI
+    fig = mlab.figure(title or 'viewer')
+    pts = mlab.points3d([0.], [0.], [0.], [0.], mode='point', colormap=colormap, figure=fig)
+    pts.actor.property.point_size = size
+
+    @mlab.animate(delay=delay, ui=False)
+    def poll():
+        while True:
+            msg = None
+            # only the newest cloud is drawn if several arrived since the last poll
+            while conn.poll():
+                msg = conn.recv()
+                if msg is None:
+                    mlab.close(all=True)
+                    GUI().stop_event_loop()
+                    return
+            if msg is not None:
+                data, scalars, name = msg
+                pts.mlab_source.reset(x=data[:,0], y=data[:,1], z=data[:,2], scalars=scalars)
+                if name: fig.name = name
+            yield
+
+    poll()
+    mlab.show()
+
+class Viewer(object):
+    """
+    Point cloud viewer running in its own process, so it survives between frames and does not block the caller
+    Clouds are sent over a pipe as float32 arrays, no files are written
+
+    Usage:
+        viewer = Viewer()
+        for pc, intensity in frames:
+            viewer.show(pc, intensity)
+        viewer.close()
+    """
+    def __init__(self, title='', colormap='Spectral', size=2, delay=50, max_points=MAX_DISPLAY_POINTS):
+        """
+        colormap: mayavi colormap of the scalars
+        max_points: display budget, see plot
+        size: point size in pixels
+        delay: ms between polls for new clouds
+        """
+        import multiprocessing as mp
+        self.max_points = max_points
+        self._conn, child_conn = mp.Pipe()
+        self._process = mp.Process(target=_viewer_loop, args=(child_conn, title, colormap, size, delay))
+        self._process.daemon = True
+        self._process.start()
+
+    def show(self, data, scalars=None, title=''):
+        """
+        data: Nx3 numpy array
+        scalars: N numpy array, colored by colormap, e.g. intensity or label
+        """
+        ids = _level_of_detail(data, self.max_points)
+        data = np.ascontiguousarray(data[ids, :3], dtype=np.float32)
+        scalars = np.zeros(data.shape[0], dtype=np.float32) if scalars is None else np.asarray(scalars, dtype=np.float32)[ids]
+        self._conn.send((data, scalars, title))
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def close(self):
+        if self._process.is_alive():
+            self._conn.send(None)
+            self._process.join()
+        self._conn.close()
+
+
+#########################################
+# offscreen batch rendering
+#########################################
+
+class FrameRenderer(object):
+    """
+    Offscreen renderer of many point cloud frames. One scene and one point actor are reused, only the point data is replaced per frame
+
+    Usage:
+        renderer = FrameRenderer(size=(1280, 720), view=(45, 60, 80, (20, 0, 0)))
+        img = renderer.render(pc, intensity)        # HxWx3 uint8 RGB
+    """
+    def __init__(self, size=(1280, 720), colormap='Spectral', point_size=2, view=None, bgcolor=(0, 0, 0),
+                 max_points=MAX_DISPLAY_POINTS, vmin=None, vmax=None):
+        """
+        size: (width, height) of rendered images
+        view: (azimuth, elevation, distance, focalpoint), see mlab.view. Default: fit the first frame
+        vmin, vmax: fixed scalar range, so colors are comparable across frames. Default: range of every frame
+        max_points: display budget, see plot
+        """
+        mlab.options.offscreen = True
+        self.fig = mlab.figure(size=size, bgcolor=bgcolor)
+        self.colormap = colormap
+        self.point_size = point_size
+        self.view = view
+        self.max_points = max_points
+        self.vmin, self.vmax = vmin, vmax
+        self.pts = None
+
+    def render(self, data, scalars=None):
+        """
+        data: Nx3 numpy array
+        scalars: N numpy array, colored by colormap
+        returns: HxWx3 uint8 RGB image
+        """
+        ids = _level_of_detail(data, self.max_points)
+        data = data[ids]
+        scalars = np.zeros(data.shape[0]) if scalars is None else np.asarray(scalars)[ids]
+        if self.pts is None:
+            self.pts = mlab.points3d(data[:,0], data[:,1], data[:,2], scalars, mode='point', colormap=self.colormap,
+                                     vmin=self.vmin, vmax=self.vmax, figure=self.fig)
+            self.pts.actor.property.point_size = self.point_size
+        else:
+            self.pts.mlab_source.reset(x=data[:,0], y=data[:,1], z=data[:,2], scalars=scalars)
+        if self.view is not None:
+            mlab.view(*self.view, figure=self.fig)
+        return mlab.screenshot(figure=self.fig, mode='rgb', antialiased=False)
+
+    def close(self):
+        mlab.close(self.fig)
+
+def _write_png(filename, img):
+    import cv2 as cv
+    cv.imwrite(filename, img[:, :, ::-1])
+
+def render_frames(frames, output, fps=10, num_workers=4, **kwargs):
+    """
+    render frames offscreen to PNG files or a video
+    frames: iterable of (data, scalars) or data, e.g. a generator reading a drive
+    output: directory for PNG files 000000.png, 000001.png, ..., or a video file name (e.g. .mp4) encoded by ffmpeg
+    fps: frame rate of the video
+    num_workers: threads encoding and writing PNG files while the next frames are rendered
+    kwargs: see FrameRenderer
+    returns: number of rendered frames
+    """
+    renderer = FrameRenderer(**kwargs)
+    to_video = os.path.splitext(output)[1] != ''
+    ffmpeg = None
+    if not to_video:
+        from multiprocessing.pool import ThreadPool
+        if not os.path.isdir(output): os.makedirs(output)
+        pool = ThreadPool(num_workers)
+        pending = []
+    count = 0
+    try:
+        for frame in frames:
+            data, scalars = frame if isinstance(frame, tuple) else (frame, None)
+            img = renderer.render(data, scalars)
+            if to_video:
+                if ffmpeg is None:
+                    # the encoder is started with the size of the first screenshot
+                    ffmpeg = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                                               '-s', '{}x{}'.format(img.shape[1], img.shape[0]), '-r', str(fps), '-i', '-',
+                                               '-pix_fmt', 'yuv420p', '-vcodec', 'libx264', output], stdin=subprocess.PIPE)
+                ffmpeg.stdin.write(np.ascontiguousarray(img).tobytes())
+            else:
+                pending.append(pool.apply_async(_write_png, (os.path.join(output, '{:06d}.png'.format(count)), img)))
+                # bound the images waiting to be written
+                while len(pending) > 2 * num_workers:
+                    pending.pop(0).get()
+            count += 1
+    finally:
+        renderer.close()
+        if ffmpeg is not None:
+            ffmpeg.stdin.close()
+            ffmpeg.wait()
+        if not to_video:
+            for r in pending: r.get()
+            pool.close()
+            pool.join()
+    return count
@@ -0,0 +1,174 @@
+'''
+variable-length point cloud batches, stored as concatenated points plus offsets
+'''
+
+import numpy as np
+
+from pclib import rotation_matrices_y, rotation_matrices_z, perturbation_rotation_matrices
+
+class RaggedBatch(object):
+    """
+    A batch of B point clouds of different sizes
+    Attributes:
+      points: TxC array, all points concatenated, T = total number of points
+      offsets: B+1 int64 array, points of sample b are points[offsets[b]:offsets[b+1]]
+      labels: T array, optional per point label
+
+    Usage:
+        batch = RaggedBatch.from_list([pc1, pc2, pc3], [label1, label2, label3])
+        batch = rotate_point_cloud_z(batch)
+        data, mask = batch.to_padded()                        # BxNxC, BxN
+    """
+    def __init__(self, points, offsets, labels=None):
+        self.points = points
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.labels = labels
+        assert self.offsets[0] == 0 and self.offsets[-1] == points.shape[0], 'offsets do not match the number of points'
+        assert labels is None or labels.shape[0] == points.shape[0], 'number of labels does not match the number of points'
+
+    @classmethod
+    def from_list(cls, point_clouds, labels=None):
+        """
+        point_clouds: list of NixC arrays
+        labels: list of Ni arrays, optional
+        """
+        lengths = [pc.shape[0] for pc in point_clouds]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.concatenate(point_clouds), offsets, None if labels is None else np.concatenate(labels))
+
+    @classmethod
+    def from_padded(cls, batch_data, mask, batch_label=None):
+        """
+        batch_data: BxNxC array
+        mask: BxN bool array, valid points
+        batch_label: BxN array, optional
+        """
+        offsets = np.zeros(batch_data.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.sum(mask, axis=1), out=offsets[1:])
+        return cls(batch_data[mask], offsets, None if batch_label is None else batch_label[mask])
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    @property
+    def lengths(self):
+        """B int64 array, number of points of every sample"""
+        return np.diff(self.offsets)
+
+    @property
+    def batch_ids(self):
+        """T int64 array, sample index of every point"""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def __getitem__(self, b):
+        """points (and labels, if present) of sample b, as views"""
+        s, e = self.offsets[b], self.offsets[b+1]
+        if self.labels is None:
+            return self.points[s:e]
+        else:
+            return self.points[s:e], self.labels[s:e]
+
+    def to_list(self):
+        return [self[b] for b in range(len(self))]
+
+    def to_padded(self, num_points=None, pad_value=0):
+        """
+        Dense batch with a validity mask
+        num_points: int, N, defaults to the largest sample. Larger samples are truncated
+        pad_value: value of padded points, and of padded labels
+        Return:
+          BxNxC array, batch_data
+          BxN bool array, mask, True for real points
+          BxN array, batch_label, if labels are present
+        """
+        lengths = self.lengths
+        N = int(np.max(lengths)) if num_points is None else num_points
+        mask = np.arange(N)[None, :] < np.minimum(lengths, N)[:, None]
+        # position of every point in its sample, points beyond N are dropped
+        rank = np.arange(self.points.shape[0]) - np.repeat(self.offsets[:-1], lengths)
+        keep = rank < N
+        batch_data = np.full((len(self), N) + self.points.shape[1:], pad_value, dtype=self.points.dtype)
+        batch_data[mask] = self.points[keep]
+        if self.labels is None:
+            return batch_data, mask
+        batch_label = np.full((len(self), N), pad_value, dtype=self.labels.dtype)
+        batch_label[mask] = self.labels[keep]
+        return batch_data, mask, batch_label
+
+    def select(self, keep):
+        """new RaggedBatch with the points where keep (T bool array) is True"""
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.batch_ids[keep], minlength=len(self)), out=offsets[1:])
+        return RaggedBatch(self.points[keep], offsets, None if self.labels is None else self.labels[keep])
+
+    def take(self, order):
+        """new RaggedBatch with points reordered by order (T int array), which must keep every point in its sample"""
+        return RaggedBatch(self.points[order], self.offsets, None if self.labels is None else self.labels[order])
+
+
+#######################################
+# augmentation of ragged batches
+#######################################
+
+def _rotate(batch, R):
+    """right-multiply the xyz channels of every sample with its Bx3x3 rotation matrix, returns a new RaggedBatch"""
+    points = batch.points.copy() if np.issubdtype(batch.points.dtype, np.floating) else batch.points.astype(np.float32)
+    R = R.astype(points.dtype, copy=False)
+    points[:, :3] = np.einsum('ti,tij->tj', points[:, :3], R[batch.batch_ids])
+    return RaggedBatch(points, batch.offsets, batch.labels)
+
+def rotate_point_cloud_y(batch, rng=None):
+    """randomly rotate every sample around y axis, see pclib.rotate_point_cloud_y"""
+    rng = np.random if rng is None else rng
+    return _rotate(batch, rotation_matrices_y(rng.uniform(size=len(batch)) * 2 * np.pi))
+
+def rotate_point_cloud_z(batch, rng=None):
+    """randomly rotate every sample around z axis, see pclib.rotate_point_cloud_z"""
+    rng = np.random if rng is None else rng
+    return _rotate(batch, rotation_matrices_z(rng.uniform(size=len(batch)) * 2 * np.pi))
+
+def rotate_perturbation_point_cloud(batch, angle_sigma=0.06, angle_clip=0.18, rng=None):
+    """randomly perturb every sample by a small rotation, see pclib.rotate_perturbation_point_cloud"""
+    rng = np.random if rng is None else rng
+    angles = np.clip(angle_sigma * rng.standard_normal(size=(len(batch), 3)), -angle_clip, angle_clip)
+    return _rotate(batch, perturbation_rotation_matrices(angles))
+
+def jitter_point_cloud(batch, sigma=0.01, clip=0.05, rng=None):
+    """randomly jitter all channels of every point, see pclib.jitter_point_cloud. Returns a new RaggedBatch"""
+    rng = np.random if rng is None else rng
+    assert(clip > 0)
+    points = np.clip(sigma * rng.standard_normal(size=batch.points.shape), -clip, clip).astype(batch.points.dtype)
+    points += batch.points
+    return RaggedBatch(points, batch.offsets, batch.labels)
+
+def shift_point_cloud(batch, shift_range=0.1, rng=None):
+    """randomly shift the xyz channels of every sample in place, see pclib.shift_point_cloud"""
+    rng = np.random if rng is None else rng
+    shifts = rng.uniform(-shift_range, shift_range, (len(batch), 3))
+    batch.points[:, :3] += np.repeat(shifts, batch.lengths, axis=0).astype(batch.points.dtype, copy=False)
+    return batch
+
+def random_scale_point_cloud(batch, scale_low=0.8, scale_high=1.25, rng=None):
+    """randomly scale the xyz channels of every sample in place, see pclib.random_scale_point_cloud"""
+    rng = np.random if rng is None else rng
+    scales = rng.uniform(scale_low, scale_high, len(batch))
+    batch.points[:, :3] *= np.repeat(scales, batch.lengths)[:, None].astype(batch.points.dtype, copy=False)
+    return batch
+
+def shuffle_points(batch, rng=None):
+    """shuffle the order of points within every sample, each with its own permutation. Returns a new RaggedBatch"""
+    rng = np.random if rng is None else rng
+    return batch.take(np.lexsort((rng.uniform(size=batch.points.shape[0]), batch.batch_ids)))
+
+def random_point_dropout(batch, max_dropout_ratio=0.875, rng=None):
+    """
+    Really remove random points, unlike pclib.random_point_dropout which overwrites them with the first point
+    The dropout ratio of every sample is uniform in [0, max_dropout_ratio), the first point of every sample is always kept
+    Returns a new RaggedBatch
+    """
+    rng = np.random if rng is None else rng
+    ratio = rng.uniform(size=len(batch)) * max_dropout_ratio
+    keep = rng.uniform(size=batch.points.shape[0]) > np.repeat(ratio, batch.lengths)
+    keep[batch.offsets[:-1][batch.lengths > 0]] = True
+    return batch.select(keep)
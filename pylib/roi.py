@@ -0,0 +1,121 @@
+'''
+region of interest filtering of point clouds
+ROIs are evaluated chunk by chunk, all ROIs on a chunk before moving to the next one, so every chunk is read from memory once
+'''
+
+import numpy as np
+
+# points per chunk, small enough for the chunk and its masks to stay in cache
+CHUNK_SIZE = 1 << 16
+
+def _columns(points, fields=('x', 'y', 'z', 'intensity')):
+    """
+    column getter of a point array
+    points: structured array with named fields, or NxC array whose columns are named by fields
+    returns: function(name) -> N array
+    """
+    if points.dtype.names is not None:
+        return lambda name: points[name]
+    index = dict((name, i) for i, name in enumerate(fields))
+    return lambda name: points[:, index[name]]
+
+class Box(object):
+    """
+    Axis-aligned box, or more generally a set of [min, max] ranges of any fields
+    e.g. Box(x=(0, 50), y=(-10, 10), z=(-2, None), intensity=(5, None)). None bounds are unbounded, None ranges are ignored
+    """
+    def __init__(self, **ranges):
+        self.ranges = [(name, r) for name, r in sorted(ranges.items()) if r is not None]
+
+    def mask(self, column):
+        """column: function(name) -> N array. returns: N bool array, or None if there is no range"""
+        mask = None
+        for name, (low, high) in self.ranges:
+            values = column(name)
+            for inside in (low is not None and values >= low, high is not None and values <= high):
+                if inside is False: continue
+                if mask is None: mask = inside
+                else: mask &= inside
+        return mask
+
+class Cylinder(object):
+    """
+    Vertical cylinder: xy distance to center at most radius, optionally within a z range
+    e.g. Cylinder((0, 0), 30, z=(-2, 3))
+    """
+    def __init__(self, center, radius, z=None):
+        self.center = center
+        self.radius = radius
+        self.z = Box(z=z)
+
+    def mask(self, column):
+        dx = column('x') - self.center[0]
+        dy = column('y') - self.center[1]
+        mask = dx * dx + dy * dy <= self.radius * self.radius
+        z = self.z.mask(column)
+        return mask if z is None else mask & z
+
+class Polygon(object):
+    """
+    Polygonal region of the ground plane, extruded vertically, optionally within a z range
+    e.g. Polygon([(0, -5), (40, -8), (40, 8), (0, 5)], z=(-2, 3))
+    """
+    def __init__(self, vertices, z=None):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        assert self.vertices.ndim == 2 and self.vertices.shape[0] >= 3, 'a polygon needs at least 3 vertices'
+        lo, hi = self.vertices.min(axis=0), self.vertices.max(axis=0)
+        self.bbox = Box(x=(lo[0], hi[0]), y=(lo[1], hi[1]), z=z)
+
+    def mask(self, column):
+        mask = self.bbox.mask(column)
+        ids = np.flatnonzero(mask)
+        x, y = column('x')[ids], column('y')[ids]
+        # even-odd rule: count crossings of a ray towards +x with every edge
+        inside = np.zeros(ids.size, dtype=bool)
+        v = self.vertices
+        for (x1, y1), (x2, y2) in zip(v, np.roll(v, -1, axis=0)):
+            if y1 == y2: continue
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        mask[ids] = inside
+        return mask
+
+class ROIFilter(object):
+    """
+    Evaluate many ROIs on a point cloud in one pass
+
+    Usage:
+        roi_filter = ROIFilter([Box(x=(0, 50), y=(-10, 10)), Cylinder((0, 0), 20), Polygon(vertices)])
+        ids = roi_filter.indices(points)        # one index array per ROI
+        mask = roi_filter.mask(points)          # points inside all ROIs
+    """
+    def __init__(self, rois, fields=('x', 'y', 'z', 'intensity'), chunk_size=CHUNK_SIZE):
+        """
+        rois: list of ROIs, objects with mask(column) -> bool array, see Box, Cylinder, Polygon
+        fields: names of the columns of plain NxC point arrays. Structured arrays use their own field names
+        """
+        self.rois = list(rois)
+        self.fields = fields
+        self.chunk_size = chunk_size
+
+    def masks(self, points):
+        """returns: RxN bool array, mask of every ROI"""
+        N = points.shape[0]
+        masks = np.ones((len(self.rois), N), dtype=bool)
+        for start in range(0, N, self.chunk_size):
+            column = _columns(points[start:start+self.chunk_size], self.fields)
+            for i, roi in enumerate(self.rois):
+                m = roi.mask(column)
+                if m is not None: masks[i, start:start+self.chunk_size] = m
+        return masks
+
+    def indices(self, points):
+        """returns: list of R int arrays, indices of the points inside every ROI"""
+        return [np.flatnonzero(m) for m in self.masks(points)]
+
+    def mask(self, points, mode='all'):
+        """returns: N bool array, points inside all ROIs (mode='all') or any ROI (mode='any')"""
+        masks = self.masks(points)
+        if mode == 'all': return np.all(masks, axis=0)
+        if mode == 'any': return np.any(masks, axis=0)
+        raise ValueError('unknown mode: {}'.format(mode))
@@ -0,0 +1,107 @@
+'''
+point cloud downsampling
+'''
+
+import numpy as np
+
+from voxel import VoxelGrid
+
+def random_subsample(n, m, rng=None):
+    """
+    Uniformly sample m distinct indices out of range(n), without permuting all n indices
+    For m <= n/2, indices are drawn with replacement and deduplicated until m are collected, costing O(m) on average
+    Input:
+      n: int, population size
+      m: int, number of samples, m <= n
+      rng: optional np.random.Generator or np.random.RandomState, defaults to the global np.random state
+    Return:
+      m int64 array, indices in random order
+    """
+    assert 0 <= m <= n, 'cannot sample {} out of {}'.format(m, n)
+    if rng is None: rng = np.random
+    if 2 * m > n:
+        # partial Fisher-Yates would touch most of the array anyway
+        ids = np.arange(n)
+        rng.shuffle(ids)
+        return ids[:m]
+    ids = np.empty(0, dtype=np.int64)
+    while ids.size < m:
+        draw = np.floor(rng.uniform(size=int((m - ids.size) * 1.2) + 16) * n).astype(np.int64)
+        ids = np.concatenate((ids, draw))
+        # keep the first occurrence of every index, in draw order
+        _, first = np.unique(ids, return_index=True)
+        ids = ids[np.sort(first)]
+    return ids[:m]
+
+def voxel_grid_downsample(points, res, labels=None, mode='centroid'):
+    """
+    Keep one point per occupied voxel
+    Input:
+      points: NxC array, the first 3 channels are xyz
+      res: float or 3 array, voxel size
+      labels: N nonnegative int array, optional per point label
+      mode: 'centroid' returns the mean of the points in every voxel (all C channels),
+            'first' returns the first point of every voxel
+    Output:
+      MxC array, downsampled points
+      M array, majority labels (centroid) or labels of the kept points (first), if labels are given
+    """
+    grid = VoxelGrid(points, res)
+    if mode == 'centroid':
+        sampled = grid.mean(points).astype(points.dtype)
+        sampled_labels = None if labels is None else grid.majority(labels)
+    elif mode == 'first':
+        sampled = points[grid.first]
+        sampled_labels = None if labels is None else labels[grid.first]
+    else:
+        raise ValueError('unknown voxel downsampling mode: {}'.format(mode))
+    if labels is None:
+        return sampled
+    else:
+        return sampled, sampled_labels
+
+def farthest_point_sample(points, m, start=None, rng=None):
+    """
+    Farthest point sampling: every new point is the one farthest from all points sampled so far
+    Each step updates the distances of all N points to the sampled set at once, O(N*M) in total
+    Input:
+      points: NxC array, the first 3 channels are xyz
+      m: int, number of samples
+      start: int, index of the first sample, random if None
+      rng: optional np.random.Generator or np.random.RandomState, used if start is None
+    Return:
+      m int64 array, indices of the sampled points
+    """
+    return batch_farthest_point_sample(points[None], m, None if start is None else [start], rng)[0]
+
+def batch_farthest_point_sample(batch_data, m, start=None, rng=None):
+    """
+    Farthest point sampling of every point cloud of a batch, vectorized over the batch
+    Input:
+      batch_data: BxNxC array, the first 3 channels are xyz
+      m: int, number of samples per point cloud
+      start: B int array, index of the first sample of every point cloud, random if None
+      rng: optional np.random.Generator or np.random.RandomState, used if start is None
+    Return:
+      BxM int64 array, indices of the sampled points
+    """
+    B, N = batch_data.shape[:2]
+    assert m <= N, 'cannot sample {} out of {} points'.format(m, N)
+    if rng is None: rng = np.random
+    xyz = batch_data[:, :, :3].astype(np.float64)
+    sq = np.einsum('bnc,bnc->bn', xyz, xyz)
+    rows = np.arange(B)
+    ids = np.empty((B, m), dtype=np.int64)
+    ids[:, 0] = np.floor(rng.uniform(size=B) * N) if start is None else start
+    min_dists = np.full((B, N), np.inf)
+    dists = np.empty((B, N))
+    for i in range(1, m):
+        # |x - p|^2 = |x|^2 - 2 x.p + |p|^2, one matrix-vector product per point cloud
+        last = ids[:, i-1]
+        np.matmul(xyz, xyz[rows, last][:, :, None], out=dists[:, :, None])
+        dists *= -2
+        dists += sq
+        dists += sq[rows, last][:, None]
+        np.minimum(min_dists, dists, out=min_dists)
+        ids[:, i] = np.argmax(min_dists, axis=1)
+    return ids
@@ -0,0 +1,353 @@
+'''
+spatial indices for neighbor queries on point clouds
+'''
+
+import numpy as np
+
+from voxel import voxel_coords, voxel_keys, group_keys
+
+# number of (query, point) candidate pairs evaluated at once
+MAX_PAIRS = 1 << 22
+
+def _expand_ranges(qids, starts, sizes, order):
+    """
+    (query, point) pairs for every query and its range order[start:start+size]
+    Return: Q' int64 array, query ids. Q' int64 array, point ids
+    """
+    total = int(np.sum(sizes))
+    pair_q = np.repeat(qids, sizes)
+    offsets = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return pair_q, order[np.repeat(starts, sizes) + offsets]
+
+def _pair_sq_dists(query, points, qids, pids):
+    """squared distances between query[qids[i]] and points[pids[i]]"""
+    dists = np.empty(qids.size)
+    for s in range(0, qids.size, MAX_PAIRS):
+        diff = query[qids[s:s+MAX_PAIRS]] - points[pids[s:s+MAX_PAIRS]]
+        dists[s:s+MAX_PAIRS] = np.einsum('ij,ij->i', diff, diff)
+    return dists
+
+def _pad_neighbors(qids, pids, sq_dists, num_queries, max_neighbors=None):
+    """
+    Padded neighbor arrays from (query, point, squared distance) triples, neighbors sorted by distance
+    max_neighbors: width of the arrays, defaults to the largest number of neighbors of a query
+    Return:
+      QxK int64 array, indices, padded with -1
+      QxK float64 array, Euclidean distances, padded with inf
+    """
+    order = np.lexsort((sq_dists, qids))
+    qids, pids, sq_dists = qids[order], pids[order], sq_dists[order]
+    counts = np.bincount(qids, minlength=num_queries)
+    rank = np.arange(qids.size) - (np.cumsum(counts) - counts)[qids]
+    K = max_neighbors if max_neighbors is not None else int(np.max(counts)) if num_queries > 0 else 0
+    keep = rank < K
+    indices = np.full((num_queries, K), -1, dtype=np.int64)
+    dists = np.full((num_queries, K), np.inf)
+    indices[qids[keep], rank[keep]] = pids[keep]
+    dists[qids[keep], rank[keep]] = np.sqrt(sq_dists[keep])
+    return indices, dists
+
+def _as_xyz(points):
+    return np.ascontiguousarray(np.asarray(points)[:, :3], dtype=np.float64)
+
+class GridIndex(object):
+    """
+    Uniform grid hash of a point cloud. Best for radius queries with r close to cell_size
+
+    Usage:
+        index = GridIndex(pc, cell_size=0.5)
+        indices, dists = index.radius(query, 0.5)   # QxK, padded with -1 / inf
+        indices, dists = index.knn(query, 8)        # Qx8
+    """
+    def __init__(self, points, cell_size):
+        """
+        points: NxC array, the first 3 channels are xyz
+        cell_size: float, edge length of grid cells
+        """
+        self.points = _as_xyz(points)
+        self.cell_size = float(cell_size)
+        # an empty cloud gets an empty grid of one cell
+        coords, self.origin = voxel_coords(self.points, self.cell_size, None if self.points.shape[0] > 0 else np.zeros(3))
+        keys, self.dims = voxel_keys(coords)
+        self.keys, inverse, counts = group_keys(keys, int(np.prod(self.dims)))
+        # points sorted by cell, points of cell i are order[starts[i]:starts[i]+counts[i]]
+        self.order = np.argsort(inverse, kind='mergesort')
+        self.counts = counts
+        self.starts = np.cumsum(counts) - counts
+
+    def _within(self, query, qids, r):
+        """
+        (query, point, squared distance) triples of all points within r of query[qids]
+        r: float, or array with the radius of every query in qids
+        Only the cells of the grid overlapping the box around every query are visited. Queries whose box covers more cells
+        than there are occupied cells are compared with all points instead
+        """
+        r = np.broadcast_to(np.asarray(r, dtype=np.float64), qids.shape)
+        q = query[qids]
+        lo = np.floor((q - r[:, None] - self.origin) / self.cell_size).astype(np.int64)
+        hi = np.floor((q + r[:, None] - self.origin) / self.cell_size).astype(np.int64)
+        lo, hi = np.maximum(lo, 0), np.minimum(hi, self.dims - 1)
+        # boxes entirely outside the grid are empty
+        sizes = np.maximum(hi - lo + 1, 0)
+        num_cells = np.prod(sizes, axis=1)
+        brute = num_cells > len(self.keys)
+        triples = [self._brute_within(query, qids[brute], r[brute])]
+        grid = np.flatnonzero(~brute & (num_cells > 0))
+        # chunks of queries visiting about MAX_PAIRS cells
+        bounds = np.searchsorted(np.cumsum(num_cells[grid]), np.arange(MAX_PAIRS, int(np.sum(num_cells[grid])), MAX_PAIRS))
+        for chunk in np.split(grid, np.unique(bounds)):
+            if chunk.size > 0:
+                triples.append(self._cells_within(query, qids[chunk], r[chunk], lo[chunk], sizes[chunk], num_cells[chunk]))
+        return tuple(np.concatenate([t[i] for t in triples]) for i in range(3))
+
+    def _cells_within(self, query, qids, r, lo, sizes, num_cells):
+        """_within for queries visiting the cells lo + [0, sizes) of the grid"""
+        cq = np.repeat(np.arange(qids.size), num_cells)
+        j = np.arange(cq.size) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+        s = sizes[cq]
+        c = lo[cq] + np.stack((j % s[:, 0], j // s[:, 0] % s[:, 1], j // (s[:, 0] * s[:, 1])), axis=1)
+        key = c[:, 0] + self.dims[0] * (c[:, 1] + self.dims[1] * c[:, 2])
+        pos = np.minimum(np.searchsorted(self.keys, key), len(self.keys) - 1)
+        found = self.keys[pos] == key
+        cq, pos = cq[found], pos[found]
+        pair_q, pair_p = _expand_ranges(qids[cq], self.starts[pos], self.counts[pos], self.order)
+        d = _pair_sq_dists(query, self.points, pair_q, pair_p)
+        keep = d <= np.repeat(r[cq], self.counts[pos]) ** 2
+        return pair_q[keep], pair_p[keep], d[keep]
+
+    def _brute_within(self, query, qids, r):
+        """_within by comparing query[qids] with all points"""
+        N = self.points.shape[0]
+        step = max(1, MAX_PAIRS // max(N, 1))
+        result_q, result_p, result_d = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for s in range(0, qids.size, step):
+            pair_q = np.repeat(qids[s:s+step], N)
+            pair_p = np.tile(np.arange(N), qids[s:s+step].size)
+            d = _pair_sq_dists(query, self.points, pair_q, pair_p)
+            keep = d <= np.repeat(r[s:s+step], N) ** 2
+            result_q.append(pair_q[keep])
+            result_p.append(pair_p[keep])
+            result_d.append(d[keep])
+        return np.concatenate(result_q), np.concatenate(result_p), np.concatenate(result_d)
+
+    def radius(self, query, r, max_neighbors=None):
+        """
+        All points within distance r of every query point
+        Input:
+          query: QxC array, the first 3 channels are xyz
+          r: float, radius
+          max_neighbors: int, keep at most this many nearest neighbors per query, defaults to the largest count
+        Return:
+          QxK int64 array, indices into points, sorted by distance and padded with -1
+          QxK float64 array, distances, padded with inf
+        """
+        query = _as_xyz(query)
+        triples = self._within(query, np.arange(query.shape[0]), r)
+        return _pad_neighbors(*triples, num_queries=query.shape[0], max_neighbors=max_neighbors)
+
+    def knn(self, query, k):
+        """
+        k nearest neighbors of every query point, by radius queries with a doubling radius, starting at the distance to the points
+        Input:
+          query: QxC array, the first 3 channels are xyz
+          k: int, number of neighbors
+        Return:
+          Qxk int64 array, indices into points, sorted by distance, padded with -1 if there are less than k points
+          Qxk float64 array, distances, padded with inf
+        """
+        query = _as_xyz(query)
+        k_ = min(k, self.points.shape[0])
+        pending = np.arange(query.shape[0])
+        result_q, result_p, result_d = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        if k_ == 0:
+            return _pad_neighbors(result_q[0], result_p[0], result_d[0], num_queries=query.shape[0], max_neighbors=k)
+        lower, upper = np.min(self.points, axis=0), np.max(self.points, axis=0)
+        # start at the distance to the bounding box of the points, stop growing once the radius reaches its farthest corner
+        r = np.linalg.norm(np.maximum(np.maximum(lower - query, query - upper), 0), axis=1) + self.cell_size
+        r_all = np.linalg.norm(np.maximum(np.abs(query - lower), np.abs(query - upper)), axis=1)
+        while pending.size > 0:
+            q, p, d = self._within(query, pending, r[pending])
+            done = (np.bincount(q, minlength=query.shape[0])[pending] >= k_) | (r[pending] >= r_all[pending])
+            finished = np.zeros(query.shape[0], dtype=bool)
+            finished[pending[done]] = True
+            keep = finished[q]
+            result_q.append(q[keep])
+            result_p.append(p[keep])
+            result_d.append(d[keep])
+            pending = pending[~done]
+            r[pending] *= 2
+        triples = np.concatenate(result_q), np.concatenate(result_p), np.concatenate(result_d)
+        return _pad_neighbors(*triples, num_queries=query.shape[0], max_neighbors=k)
+
+class KDTree(object):
+    """
+    KD-tree of a point cloud, queries are processed for all query points at once, level by level
+
+    Usage:
+        tree = KDTree(pc)
+        indices, dists = tree.knn(query, 8)         # Qx8
+        indices, dists = tree.radius(query, 0.5)    # QxK, padded with -1 / inf
+    """
+    def __init__(self, points, leaf_size=32):
+        """
+        points: NxC array, the first 3 channels are xyz
+        leaf_size: maximum number of points in a leaf
+        """
+        self.points = _as_xyz(points)
+        self.leaf_size = leaf_size
+        N = self.points.shape[0]
+        self.order = np.arange(N)
+        # node arrays, a node is a leaf if left == -1
+        lo, hi, left, right, start, end, split_dim, split_val = [], [], [], [], [], [], [], []
+        def new_node(s, e):
+            pts = self.points[self.order[s:e]]
+            lo.append(np.min(pts, axis=0) if e > s else np.full(3, np.inf))
+            hi.append(np.max(pts, axis=0) if e > s else np.full(3, -np.inf))
+            for a in (left, right, split_dim): a.append(-1)
+            split_val.append(0.)
+            start.append(s)
+            end.append(e)
+            return len(start) - 1
+        stack = [new_node(0, N)]
+        while stack:
+            node = stack.pop()
+            s, e = start[node], end[node]
+            if e - s <= leaf_size: continue
+            dim = int(np.argmax(hi[node] - lo[node]))
+            mid = (s + e) // 2
+            ids = self.order[s:e]
+            part = np.argpartition(self.points[ids, dim], mid - s)
+            self.order[s:e] = ids[part]
+            split_dim[node] = dim
+            split_val[node] = self.points[self.order[mid], dim]
+            left[node] = new_node(s, mid)
+            right[node] = new_node(mid, e)
+            stack.extend((left[node], right[node]))
+        self.lo, self.hi = np.array(lo), np.array(hi)
+        self.left, self.right = np.array(left), np.array(right)
+        self.start, self.end = np.array(start), np.array(end)
+        self.split_dim, self.split_val = np.array(split_dim), np.array(split_val)
+
+    def _leaf_of(self, query):
+        """leaf that would contain every query point"""
+        node = np.zeros(query.shape[0], dtype=np.int64)
+        inner = np.where(self.left[node] >= 0)[0]
+        while inner.size > 0:
+            n = node[inner]
+            go_left = query[inner, self.split_dim[n]] < self.split_val[n]
+            node[inner] = np.where(go_left, self.left[n], self.right[n])
+            inner = inner[self.left[node[inner]] >= 0]
+        return node
+
+    def _leaf_triples(self, query, qids, leaves):
+        """(query, point, squared distance) triples of all points in the given (query, leaf) pairs"""
+        pair_q, pair_p = _expand_ranges(qids, self.start[leaves], self.end[leaves] - self.start[leaves], self.order)
+        return pair_q, pair_p, _pair_sq_dists(query, self.points, pair_q, pair_p)
+
+    def _search(self, query, bound, skip_leaf=None):
+        """
+        (query, point, squared distance) triples of all points in leaves whose box is within sqrt(bound[q]) of query q
+        skip_leaf: Q array, leaf that has already been visited by every query
+        """
+        qids = np.arange(query.shape[0])
+        node = np.zeros(query.shape[0], dtype=np.int64)
+        result_q, result_p, result_d = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        while qids.size > 0:
+            gap = np.maximum(np.maximum(self.lo[node] - query[qids], query[qids] - self.hi[node]), 0)
+            keep = np.einsum('ij,ij->i', gap, gap) <= bound[qids]
+            qids, node = qids[keep], node[keep]
+            is_leaf = self.left[node] < 0
+            leaf_q, leaf_n = qids[is_leaf], node[is_leaf]
+            if skip_leaf is not None:
+                new = leaf_n != skip_leaf[leaf_q]
+                leaf_q, leaf_n = leaf_q[new], leaf_n[new]
+            q, p, d = self._leaf_triples(query, leaf_q, leaf_n)
+            keep = d <= bound[q]
+            result_q.append(q[keep])
+            result_p.append(p[keep])
+            result_d.append(d[keep])
+            qids, node = qids[~is_leaf], node[~is_leaf]
+            qids, node = np.concatenate((qids, qids)), np.concatenate((self.left[node], self.right[node]))
+        return np.concatenate(result_q), np.concatenate(result_p), np.concatenate(result_d)
+
+    def knn(self, query, k):
+        """
+        k nearest neighbors of every query point
+        The leaf containing a query gives an upper bound of its k-th distance, which prunes the search of the other leaves
+        Input:
+          query: QxC array, the first 3 channels are xyz
+          k: int, number of neighbors
+        Return:
+          Qxk int64 array, indices into points, sorted by distance, padded with -1 if there are less than k points
+          Qxk float64 array, distances, padded with inf
+        """
+        query = _as_xyz(query)
+        Q = query.shape[0]
+        leaves = self._leaf_of(query)
+        first = self._leaf_triples(query, np.arange(Q), leaves)
+        bound = _pad_neighbors(*first, num_queries=Q, max_neighbors=k)[1][:, -1] ** 2 if k > 0 else np.zeros(Q)
+        rest = self._search(query, bound, skip_leaf=leaves)
+        triples = [np.concatenate((a, b)) for a, b in zip(first, rest)]
+        return _pad_neighbors(*triples, num_queries=Q, max_neighbors=k)
+
+    def radius(self, query, r, max_neighbors=None):
+        """
+        All points within distance r of every query point
+        Input:
+          query: QxC array, the first 3 channels are xyz
+          r: float, radius
+          max_neighbors: int, keep at most this many nearest neighbors per query, defaults to the largest count
+        Return:
+          QxK int64 array, indices into points, sorted by distance and padded with -1
+          QxK float64 array, distances, padded with inf
+        """
+        query = _as_xyz(query)
+        triples = self._search(query, np.full(query.shape[0], float(r) * r))
+        return _pad_neighbors(*triples, num_queries=query.shape[0], max_neighbors=max_neighbors)
+
+
+def brute_force_knn(points, query, k):
+    """
+    Reference k nearest neighbors by computing all QxN distances in chunks
+    Return: see KDTree.knn
+    """
+    points, query = _as_xyz(points), _as_xyz(query)
+    k_ = min(k, points.shape[0])
+    indices = np.full((query.shape[0], k), -1, dtype=np.int64)
+    dists = np.full((query.shape[0], k), np.inf)
+    sq = np.einsum('ij,ij->i', points, points)
+    chunk = max(1, MAX_PAIRS // max(points.shape[0], 1))
+    for s in range(0, query.shape[0], chunk):
+        q = query[s:s+chunk]
+        d = np.einsum('ij,ij->i', q, q)[:, None] - 2 * np.dot(q, points.T) + sq[None, :]
+        np.maximum(d, 0, out=d)
+        idx = np.argpartition(d, k_ - 1, axis=1)[:, :k_] if k_ < points.shape[0] else np.tile(np.arange(k_), (q.shape[0], 1))
+        dd = np.take_along_axis(d, idx, axis=1)
+        o = np.argsort(dd, axis=1)
+        indices[s:s+chunk, :k_] = np.take_along_axis(idx, o, axis=1)
+        dists[s:s+chunk, :k_] = np.sqrt(np.take_along_axis(dd, o, axis=1))
+    return indices, dists
+
+def _spatial_benchmark(num_points=10**5, num_queries=10**4, k=16, r=0.5, extent=(50., 50., 3.)):
+    """time knn and radius queries of GridIndex and KDTree against brute force on a random LiDAR-like cloud"""
+    import time
+    points = np.random.random((num_points, 3)) * extent
+    query = np.random.random((num_queries, 3)) * extent
+    start = time.time()
+    ref_idx, ref_dist = brute_force_knn(points, query, k)
+    print('brute force knn: {:.3f} s'.format(time.time() - start))
+    for name, build in (('grid', lambda: GridIndex(points, r)), ('kdtree', lambda: KDTree(points))):
+        start = time.time()
+        index = build()
+        t_build = time.time() - start
+        start = time.time()
+        idx, dist = index.knn(query, k)
+        t_knn = time.time() - start
+        start = time.time()
+        index.radius(query, r)
+        t_radius = time.time() - start
+        print('{:>6s}: build {:.3f} s, knn {:.3f} s (max error {:.2e}), radius {:.3f} s'.format(
+            name, t_build, t_knn, np.max(np.abs(dist - ref_dist)), t_radius))
+
+if __name__ == '__main__':
+    _spatial_benchmark()
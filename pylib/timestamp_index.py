@@ -0,0 +1,114 @@
+'''
+timestamp alignment of multi-sensor recordings
+every frame of a reference topic is matched to the nearest message of every other topic by binary search,
+so aligned frame lists of whole bags can be planned from timestamps alone, before fetching any data
+'''
+
+import numpy as np
+
+def nearest(timestamps, query):
+    """
+    nearest neighbour of every query in a sorted timestamp array, by binary search
+    timestamps: sorted N int64 array, e.g. nanoseconds
+    query: M array
+    returns: M int64 array, indices into timestamps. M int64 array, offsets query - timestamps[indices]
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    query = np.asarray(query, dtype=np.int64)
+    assert timestamps.shape[0] > 0, 'no timestamps to match against'
+    right = np.searchsorted(timestamps, query)
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, timestamps.shape[0] - 1)
+    d_left = query - timestamps[left]
+    d_right = query - timestamps[right]
+    use_right = np.abs(d_right) < np.abs(d_left)
+    indices = np.where(use_right, right, left)
+    return indices, np.where(use_right, d_right, d_left)
+
+class AlignmentIndex(object):
+    """
+    Nearest-timestamp matching of several topics against a reference topic
+
+    Usage:
+        index = AlignmentIndex({'lidar_left': ts0, 'lidar_right': ts1, 'camera1': ts2}, 'lidar_left', threshold=0.05)
+        index.stats()                                   # misalignment per topic
+        for ts in index.frames(ts_begin, limit=100):    # dict topic -> timestamp of every aligned frame
+            ...
+        index.save('bag.align.npz'); index = AlignmentIndex.load('bag.align.npz')
+    """
+    def __init__(self, timestamps, reference, threshold=0.05, scale=1e9):
+        """
+        timestamps: dict topic -> sorted int64 array of message timestamps
+        reference: topic whose frames are matched, its timestamps are the frame timestamps
+        threshold: maximum misalignment (seconds) of an aligned frame
+        scale: timestamp units per second, 1e9 for nanoseconds
+        """
+        assert reference in timestamps, 'reference topic {} has no timestamps'.format(reference)
+        self.timestamps = dict((topic, np.asarray(ts, dtype=np.int64)) for topic, ts in timestamps.items())
+        for topic, ts in self.timestamps.items():
+            assert np.all(ts[1:] >= ts[:-1]), 'timestamps of {} are not sorted'.format(topic)
+        self.reference = reference
+        self.threshold = threshold
+        self.scale = scale
+        self.topics = [reference] + sorted(t for t in self.timestamps if t != reference)
+        self._match()
+
+    def _match(self):
+        ref = self.timestamps[self.reference]
+        # T x F matched message indices and offsets to the reference frame, topics ordered as self.topics
+        self.indices = np.empty((len(self.topics), ref.shape[0]), dtype=np.int64)
+        self.offsets = np.empty((len(self.topics), ref.shape[0]), dtype=np.int64)
+        for i, topic in enumerate(self.topics):
+            self.indices[i], self.offsets[i] = nearest(self.timestamps[topic], ref)
+        self.aligned = np.all(np.abs(self.offsets) <= self.threshold * self.scale, axis=0)
+
+    def __len__(self):
+        return self.indices.shape[1]
+
+    def frame_ids(self, ts_begin=None, ts_end=None, limit=None, aligned_only=True):
+        """reference frame indices in [ts_begin, ts_end), at most limit of them"""
+        ref = self.timestamps[self.reference]
+        start = 0 if ts_begin is None else np.searchsorted(ref, ts_begin)
+        stop = len(self) if ts_end is None else np.searchsorted(ref, ts_end)
+        ids = np.arange(start, stop)
+        if aligned_only: ids = ids[self.aligned[start:stop]]
+        return ids if limit is None else ids[:limit]
+
+    def frames(self, ts_begin=None, ts_end=None, limit=None, aligned_only=True):
+        """list of dicts topic -> matched timestamp, one per frame, see frame_ids"""
+        ids = self.frame_ids(ts_begin, ts_end, limit, aligned_only)
+        matched = [self.timestamps[topic][self.indices[i, ids]] for i, topic in enumerate(self.topics)]
+        return [dict(zip(self.topics, ts)) for ts in zip(*[m.tolist() for m in matched])]
+
+    def stats(self):
+        """
+        misalignment statistics, dict topic -> dict with keys
+          mean, median, p95, max: absolute offsets (seconds) over all reference frames
+          misaligned: number of frames whose offset exceeds threshold
+          reused: number of frames matched to a message already used by the previous frame
+        plus key 'aligned': number of frames aligned on all topics
+        """
+        stats = {'aligned': int(np.sum(self.aligned))}
+        for i, topic in enumerate(self.topics[1:], 1):
+            offsets = np.abs(self.offsets[i]) / float(self.scale)
+            if offsets.size == 0:
+                stats[topic] = dict(mean=0., median=0., p95=0., max=0., misaligned=0, reused=0)
+                continue
+            stats[topic] = dict(mean=float(np.mean(offsets)), median=float(np.median(offsets)),
+                                p95=float(np.percentile(offsets, 95)), max=float(np.max(offsets)),
+                                misaligned=int(np.sum(offsets > self.threshold)),
+                                reused=int(np.sum(self.indices[i, 1:] == self.indices[i, :-1])))
+        return stats
+
+    def save(self, filename):
+        """npz with the timestamps of every topic, matching is redone on load"""
+        topics = sorted(self.timestamps)
+        arrays = dict(('ts_{}'.format(i), self.timestamps[topic]) for i, topic in enumerate(topics))
+        np.savez(filename, topics=np.array(topics, dtype=np.str_), reference=np.array(self.reference),
+                 threshold=np.array(self.threshold), scale=np.array(self.scale), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        f = np.load(filename)
+        timestamps = dict((str(topic), f['ts_{}'.format(i)]) for i, topic in enumerate(f['topics']))
+        return cls(timestamps, str(f['reference']), float(f['threshold']), float(f['scale']))
@@ -6,30 +6,29 @@ import numpy as np
 ######################################
 
 def read_pcd(pcd_filename):
-    from py_lidar_bind import get_single_point_cloud
-    pcd = get_single_point_cloud(pcd_filename)
-    pc = pcd[0]
-    intensity = pcd[1][:,0]
+    """
+    pcd_filename: str, PCD file with fields x, y, z and optionally intensity
+    returns: pc, ndarray (N, 3), intensity, ndarray (N,) or None. Both keep the dtypes of the file
+    """
+    import pcd
+    data = pcd.read_pcd(pcd_filename)
+    pc = pcd.xyz(data)
+    intensity = data['intensity'] if 'intensity' in data.dtype.names else None
     return pc, intensity
 
-def save_pcd(filename, pc, intensity=None, label=None, ASCIIFlag=True):
+def save_pcd(filename, pc, intensity=None, label=None, ASCIIFlag=False):
     """
     pc: ndarray, (N, 3)
     intensity: ndarray, (N,)
+    label: ndarray, (N,)
+    ASCIIFlag: write DATA ascii instead of binary
+    float32 inputs are written as float32
     """
-    if intensity is None and label is None:
-        from py_lidar_bind import save_point_cloud
-        save_point_cloud(pc.astype(np.float64), filename, ASCIIFlag=ASCIIFlag)
-    else:
-        data = np.zeros((pc.shape[0], 3))
-        if intensity is not None:
-            data[:,0] = intensity
-        if label is not None:
-            data[:,2] = label
-        else:
-            data[:,2] = np.ones(pc.shape[0])
-        from py_lidar_bind import save_point_cloud_with_data
-        save_point_cloud_with_data(pc.astype(np.float64), data.astype(np.float64), filename, ASCIIFlag=ASCIIFlag)
+    import pcd
+    fields = {'x': pc[:,0], 'y': pc[:,1], 'z': pc[:,2]}
+    if intensity is not None: fields['intensity'] = intensity
+    if label is not None: fields['label'] = label
+    pcd.write_pcd(filename, pcd.to_structured(**fields), 'ascii' if ASCIIFlag else 'binary')
 
 def plot_pcd(pcd_filename, bg=False):
     import subprocess
@@ -40,32 +39,59 @@ def plot_pcd(pcd_filename, bg=False):
     else:
         subprocess.call(cmd_args)
 
-def plot_pc(pc, intensity=None, label=None, bg=False):
+def _temp_filename(suffix):
+    """unique temporary file name, so concurrent plots do not overwrite each other"""
+    import tempfile
+    fd, filename = tempfile.mkstemp(suffix=suffix, prefix='plot_')
+    os.close(fd)
+    return filename
+
+def _view_and_remove(cmd_args, filename, bg):
+    """run a viewer on filename and remove the file when the viewer exits. bg: return the process instead of waiting"""
+    import subprocess
+    import threading
+    p = subprocess.Popen(cmd_args)
+    if not bg:
+        p.wait()
+        os.remove(filename)
+        return
+    def wait_and_remove():
+        p.wait()
+        os.remove(filename)
+    t = threading.Thread(target=wait_and_remove)
+    t.daemon = True
+    t.start()
+    return p
+
+def plot_pc(pc, intensity=None, label=None, bg=False, viewer=None):
     """
     bg: if True, plot pc in a separate process and return the process
+    viewer: pcplot.Viewer, if given the cloud is sent to it instead of writing a file for pcl_viewer,
+            colored by label, or intensity if there is no label
     """
-    tmp_pcd_filename = os.path.join(os.environ['HOME'], 'tmp', 'tmp.pcd')
+    if viewer is not None:
+        viewer.show(pc, label if label is not None else intensity)
+        return
+    tmp_pcd_filename = _temp_filename('.pcd')
     save_pcd(tmp_pcd_filename, pc, intensity, label)
-    p = plot_pcd(tmp_pcd_filename, bg)
-    return p
+    return _view_and_remove(['pcl_viewer', tmp_pcd_filename], tmp_pcd_filename, bg)
 
 def plot_img(img, bg=False):
-    import subprocess
     import cv2 as cv
-    tmp_img_filename = os.path.join(os.environ['HOME'], 'tmp', 'tmp.jpg')
+    tmp_img_filename = _temp_filename('.jpg')
     cv.imwrite(tmp_img_filename, img)
-    cmd_args = ['eog', tmp_img_filename]
-    if bg:
-        p = subprocess.Popen(cmd_args)
-        return p
-    else:
-        subprocess.call(cmd_args)
+    return _view_and_remove(['eog', tmp_img_filename], tmp_img_filename, bg)
 
-def plot_pc_with_image(pc, intensity=None, label=None, img=None):
-    p = plot_pc(pc, intensity, label, bg=True)
+def plot_pc_with_image(pc, intensity=None, label=None, img=None, viewer=None):
+    """
+    show pc and img, returns when the image viewer (or, without image and viewer, pcl_viewer) is closed
+    viewer: pcplot.Viewer, see plot_pc
+    """
+    p = plot_pc(pc, intensity, label, bg=True, viewer=viewer)
     if img is not None:
         plot_img(img)
-    p.wait()
+    if p is not None:
+        p.wait()
 
 
 #######################################
@@ -75,20 +101,115 @@ def plot_pc_with_image(pc, intensity=None, label=None, img=None):
 def _check_fetched_ts(data, threshold=0.05):
     """
     check ts from fetched data, make sure the data is correctly aligned
+    to plan aligned frames of a whole bag beforehand, see timestamp_index.AlignmentIndex
     data: return value from Dataset.fetch_aligned
     threshold: maximum ts misalignment (seconds)
     return: boolean
     """
-    ts = data[0][0] / 1e9
-    flag = True
-    for t, _ in data:
-        if abs(t/1e9 - ts) > threshold:
-            print "dataset is not correctly aligned at ts = {}".format(ts)
-            flag = False
+    ts = np.array([t for t, _ in data], dtype=np.int64)
+    flag = bool(np.all(np.abs(ts - ts[0]) <= threshold * 1e9))
+    if not flag:
+        print "dataset is not correctly aligned at ts = {}".format(ts[0] / 1e9)
     return flag
 
+def _make_pc_loader(vehicle, bag_name):
+    """ CLoader converting Pandar packets of the left and right lidars to point clouds, with the calibration of the bag """
+    from calibration_manager import CalibrationManager
+    calib_manager = CalibrationManager({'vehicle': vehicle, 'bag_name': bag_name})
+    lidar_calibs = calib_manager.get_lidars()
+    intrinsic_file_paths = [lidar_calibs[i]['intrinsic_file_path'] for i in (1,2)]
+    extrinsic_matrices = [lidar_calibs[i]['extrinsic']['imu-0'] for i in (1,2)]
+    from py_lidar.loader import CLoader
+    return CLoader(intrinsic_file_paths, extrinsic_matrices, lidar_type='Pandar40')
+
+class _PerThreadLoader(object):
+    """ proxy of a lidar loader with one instance per thread, created by factory on first use in that thread
+    CLoader is a stateful native object, so threads must never call grab() on the same instance
+    """
+    def __init__(self, factory):
+        import threading
+        self.factory = factory
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        loader = getattr(self.local, 'loader', None)
+        if loader is None:
+            loader = self.local.loader = self.factory()
+        return getattr(loader, name)
+
+def _process_frame(data, pc_loader, roi_filter):
+    """ decode image and convert packets of one aligned frame, keep points inside all ROIs. returns pc, intensity, image """
+    import cv2
+    _check_fetched_ts(data)
+    im = cv2.imdecode(np.frombuffer(data[2][1].data, np.uint8), cv2.IMREAD_COLOR)
+    packet_left, packet_right = data[0][1], data[1][1]
+    pc = pc_loader.grab([packet_left, packet_right])[0]
+    pc = pc[roi_filter.mask(pc)]
+    return pc[:,:3], pc[:,3], im
+
+def stream_frames(vehicle, bag_name, ts_begin, camera=1, limit=1,
+                  x=None, y=None, z=None, intensity=None, roi=None,
+                  num_workers=4, prefetch=8, dataset=None, pc_loader_factory=None, process_frame=None):
+    """
+    generator of aligned (pc, intensity, image) frames, in timestamp order
+    A fetcher thread reads aligned messages while a thread pool decodes images and converts packets
+    (cv2.imdecode and the lidar loader release the GIL), with at most `prefetch` frames in flight.
+    Every decoding thread creates and uses its own lidar loader, loaders are never shared between threads.
+    vehicle, bag_name, ts_begin, camera, limit, x, y, z, intensity, roi: see peak
+    num_workers: int, number of decoding threads
+    prefetch: int, maximum number of frames fetched ahead of the consumer
+    dataset: object with fetch_aligned(*topics, ts_begin=, limit=), defaults to dataset_store.Dataset.open(bag_name)
+    pc_loader_factory: function() -> new object with grab([packet_left, packet_right]) returning a list whose first item is an Nx4 array
+                       (x, y, z, intensity). Called once per decoding thread. Defaults to a CLoader with the calibration of the bag
+    process_frame: function(data, pc_loader, roi_filter) -> (pc, intensity, image), defaults to _process_frame.
+                   pc_loader is a proxy of the loader of the calling thread
+    """
+    import threading
+    from multiprocessing.pool import ThreadPool
+    try:
+        from queue import Queue
+    except ImportError:
+        from Queue import Queue
+    topics = ['/pandar_left/pandar_packets', '/pandar_right/pandar_packets', '/camera{}/image_color/compressed'.format(camera)]
+    if pc_loader_factory is None: pc_loader_factory = lambda: _make_pc_loader(vehicle, bag_name)
+    pc_loader = _PerThreadLoader(pc_loader_factory)
+    if dataset is None:
+        from dataset_store import Dataset
+        dataset = Dataset.open(bag_name)
+    if process_frame is None: process_frame = _process_frame
+    from roi import ROIFilter, Box
+    roi_filter = ROIFilter([Box(x=x, y=y, z=z, intensity=intensity)] + ([] if roi is None else [roi]))
+
+    pool = ThreadPool(num_workers)
+    pending = Queue(maxsize=prefetch)  # AsyncResults in fetch order, None at the end
+    stop = threading.Event()
+    def fetch():
+        try:
+            for data in dataset.fetch_aligned(*topics, ts_begin=ts_begin, limit=limit):
+                if stop.is_set(): break
+                pending.put(pool.apply_async(process_frame, (data, pc_loader, roi_filter)))
+        except Exception as e:
+            pending.put(e)
+        pending.put(None)
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is None: break
+            if isinstance(item, Exception): raise item
+            yield item.get()
+    finally:
+        # unblock the fetcher if the consumer stops early
+        stop.set()
+        while fetcher.is_alive():
+            while not pending.empty(): pending.get()
+            fetcher.join(0.1)
+        pool.terminate()
+
 def peak(vehicle, bag_name, ts_begin, camera=1, limit=1,
-         x=None, y=None, z=None, intensity=None):
+         x=None, y=None, z=None, intensity=None, roi=None, num_workers=4, viewer=None):
     """
     peak dataset (camera and lidar) at a given timestamp
     vehicle: str, vehicle name, e.g. 'Octopus-B1'
@@ -97,40 +218,9 @@ def peak(vehicle, bag_name, ts_begin, camera=1, limit=1,
     camera: int, camera id
     limit: int, number of frames to show
     x, y, z, intensity: list of length 2, [min, max] range
-    pc_viewer: 'mayavi' or 'pcl_viewer'
+    roi: additional region of interest, e.g. roi.Cylinder((0, 0), 30) or roi.Polygon(vertices)
+    num_workers: int, number of threads decoding frames ahead of the viewer, see stream_frames
+    viewer: pcplot.Viewer, reused for all frames instead of starting pcl_viewer per frame
     """
-    import cv2
-    import subprocess
-    topics = ['/pandar_left/pandar_packets', '/pandar_right/pandar_packets', '/camera{}/image_color/compressed'.format(camera)]
-    # get correction and calibration info
-    from calibration_manager import CalibrationManager
-    calib_manager = CalibrationManager({'vehicle': vehicle, 'bag_name': bag_name})
-    lidar_calibs = calib_manager.get_lidars()
-    intrinsic_file_paths = [lidar_calibs[i]['intrinsic_file_path'] for i in (1,2)]
-    extrinsic_matrices = [lidar_calibs[i]['extrinsic']['imu-0'] for i in (1,2)]
-    # Loader for lidar packets to point cloud
-    from py_lidar.loader import CLoader
-    from py_lidar_bind import save_point_cloud_with_data
-    pc_loader = CLoader(intrinsic_file_paths, extrinsic_matrices, lidar_type='Pandar40')
-    # fetch dataset
-    from dataset_store import Dataset
-    ds = Dataset.open(bag_name)
-    for data in ds.fetch_aligned(*topics, ts_begin=ts_begin, limit=limit):
-        _check_fetched_ts(data)
-        im = cv2.imdecode(np.fromstring(data[2][1].data, np.uint8), cv2.IMREAD_COLOR)
-        packet_left, packet_right = data[0][1], data[1][1]
-        pc = pc_loader.grab([packet_left, packet_right])[0]
-        pc, intensity = pc[:,:3], pc[:,3]
-        # mask
-        mask = np.ones(pc.shape[0], dtype=np.bool)
-        if x is not None:
-            mask &= (pc[:,0] >= x[0]) & (pc[:,0] <= x[1])
-        if y is not None:
-            mask &= (pc[:,1] >= y[0]) & (pc[:,1] <= y[1])
-        if z is not None:
-            mask &= (pc[:,2] >= z[0]) & (pc[:,2] <= z[1])
-        if intensity is not None:
-            mask &= (data_[:,0] >= intensity[0]) & (data_[:,0] <= intensity[1])
-        pc, intensity = pc[mask], intensity[mask]
-        plot_pc_with_image(pc, intensity, None, im)
-
+    for pc, intensity_, im in stream_frames(vehicle, bag_name, ts_begin, camera, limit, x, y, z, intensity, roi, num_workers=num_workers):
+        plot_pc_with_image(pc, intensity_, None, im, viewer)
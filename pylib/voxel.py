@@ -0,0 +1,170 @@
+'''
+sparse voxelization of point clouds
+'''
+
+import numpy as np
+
+# dense key ranges up to max(DENSE_FACTOR * N, DENSE_MIN) are grouped by counting sort, larger ones by radix sort
+DENSE_FACTOR = 8
+DENSE_MIN = 1 << 20
+
+def voxel_coords(points, res, origin=None):
+    """
+    Integer voxel coordinates of points
+    Input:
+      points: NxC array, the first 3 channels are xyz
+      res: float or 3 array, voxel size
+      origin: 3 array, corner of voxel (0, 0, 0), defaults to the minimum of points
+    Return:
+      Nx3 int64 array, voxel coordinates
+      3 array, origin
+    """
+    xyz = points[:, :3]
+    if origin is None: origin = np.min(xyz, axis=0)
+    coords = np.floor((xyz - origin) / res).astype(np.int64)
+    return coords, np.asarray(origin)
+
+def voxel_keys(coords):
+    """
+    Linear int64 keys of nonnegative voxel coordinates, x changes fastest
+    Input:
+      Nx3 int64 array, voxel coordinates
+    Return:
+      N int64 array, keys
+      3 int64 array, dims, number of voxels along each axis
+    """
+    dims = np.max(coords, axis=0) + 1 if coords.shape[0] > 0 else np.ones(3, dtype=np.int64)
+    assert np.all(coords >= 0), 'voxel coordinates must be nonnegative'
+    assert float(dims[0]) * dims[1] * dims[2] < 2**62, 'too many voxels for int64 keys: {}'.format(dims)
+    keys = coords[:, 0] + dims[0] * (coords[:, 1] + dims[1] * coords[:, 2])
+    return keys, dims
+
+def _radix_argsort(keys, num_keys):
+    """
+    stable argsort of nonnegative int64 keys below num_keys, by LSD radix sort on 16-bit digits
+    numpy sorts uint16 with kind='stable' by counting sort, so every pass is O(N)
+    """
+    order = None
+    for shift in range(0, max(int(num_keys - 1).bit_length(), 1), 16):
+        digits = (keys >> shift).astype(np.uint16)
+        o = np.argsort(digits if order is None else digits[order], kind='stable')
+        order = o if order is None else order[o]
+    return order
+
+def group_keys(keys, num_keys=None):
+    """
+    Group equal keys in O(N). Uses a counting sort in O(N + num_keys) if the key range is small enough,
+    otherwise a radix sort in O(N * log(num_keys) / 16)
+    Input:
+      N int64 array, nonnegative keys
+      num_keys: int, upper bound of the keys, defaults to max(keys) + 1
+    Return:
+      M int64 array, unique keys in increasing order
+      N array, inverse, index of the unique key of every input key
+      M array, counts, number of inputs with every unique key
+    """
+    N = keys.shape[0]
+    if num_keys is None: num_keys = int(np.max(keys)) + 1 if N > 0 else 0
+    if num_keys <= max(DENSE_FACTOR * N, DENSE_MIN):
+        counts = np.bincount(keys, minlength=num_keys)
+        unique_keys = np.flatnonzero(counts)
+        lut = np.cumsum(counts > 0) - 1
+        return unique_keys, lut[keys], counts[unique_keys]
+    order = _radix_argsort(keys, num_keys)
+    sorted_keys = keys[order]
+    new = np.empty(N, dtype=bool)
+    new[:1] = True
+    np.not_equal(sorted_keys[1:], sorted_keys[:-1], out=new[1:])
+    starts = np.flatnonzero(new)
+    inverse = np.empty(N, dtype=np.int64)
+    inverse[order] = np.cumsum(new) - 1
+    return sorted_keys[starts], inverse, np.diff(np.append(starts, N))
+
+class VoxelGrid(object):
+    """
+    Sparse voxel grid of a point cloud
+    Attributes:
+      res, origin: voxel size and corner of voxel (0, 0, 0)
+      keys: M int64 array, linear keys of the occupied voxels, see voxel_keys
+      coords: Mx3 int64 array, voxel coordinates of the occupied voxels
+      inverse: N array, index of the voxel of every point
+      counts: M array, number of points in every voxel
+      centroids: Mx3 array, mean xyz of the points in every voxel
+      first: M array, index of the first point in every voxel
+      labels: M array, majority label of every voxel, if labels are given
+    """
+    def __init__(self, points, res, labels=None, origin=None):
+        """
+        points: NxC array, the first 3 channels are xyz
+        res: float or 3 array, voxel size
+        labels: N nonnegative int array, optional per point label
+        origin: 3 array, defaults to the minimum of points
+        """
+        self.res = res
+        coords, self.origin = voxel_coords(points, res, origin)
+        keys, self.dims = voxel_keys(coords)
+        self.keys, self.inverse, self.counts = group_keys(keys, int(np.prod(self.dims)))
+        self.coords = np.stack((self.keys % self.dims[0],
+                                self.keys // self.dims[0] % self.dims[1],
+                                self.keys // (self.dims[0] * self.dims[1])), axis=1)
+        self.num_points = points.shape[0]
+        self.centroids = self.mean(points[:, :3])
+        # the first write of every voxel wins when assigning in reversed order
+        self.first = np.empty(len(self), dtype=np.int64)
+        self.first[self.inverse[::-1]] = np.arange(self.num_points - 1, -1, -1)
+        self.labels = None if labels is None else self.majority(labels)
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def sum(self, values):
+        """
+        Per voxel sum of per point values
+        Input: N or NxC array
+        Return: M or MxC float64 array
+        """
+        values = np.asarray(values)
+        if values.ndim == 1:
+            return np.bincount(self.inverse, weights=values, minlength=len(self))
+        return np.stack([np.bincount(self.inverse, weights=values[:, c], minlength=len(self))
+                         for c in range(values.shape[1])], axis=1)
+
+    def mean(self, values):
+        """
+        Per voxel mean of per point values
+        Input: N or NxC array
+        Return: M or MxC float64 array
+        """
+        s = self.sum(values)
+        return s / (self.counts if s.ndim == 1 else self.counts[:, None])
+
+    def majority(self, labels):
+        """
+        Per voxel most frequent label, ties go to the smaller label
+        Input: N nonnegative int array
+        Return: M array
+        """
+        labels = np.asarray(labels)
+        num_labels = int(np.max(labels)) + 1 if labels.size > 0 else 1
+        if len(self) * num_labels <= max(DENSE_FACTOR * self.num_points, DENSE_MIN):
+            hist = np.bincount(self.inverse * num_labels + labels, minlength=len(self) * num_labels)
+            return np.argmax(hist.reshape(len(self), num_labels), axis=1).astype(labels.dtype)
+        # sparse labels: count (voxel, label) pairs, then pick the largest count of every voxel
+        pairs, counts = np.unique(self.inverse.astype(np.int64) * num_labels + labels, return_counts=True)
+        voxel = pairs // num_labels
+        order = np.lexsort((-counts, voxel))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = voxel[order][1:] != voxel[order][:-1]
+        return (pairs[order][first] % num_labels).astype(labels.dtype)
+
+    def groups(self):
+        """
+        Points grouped by voxel, CSR style. Sorting makes this O(N log N), unlike the other members
+        Return:
+          N array, order, point indices sorted by voxel
+          M+1 array, offsets, points of voxel i are order[offsets[i]:offsets[i+1]]
+        """
+        order = np.argsort(self.inverse, kind='mergesort')
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=offsets[1:])
+        return order, offsets